@@ -3,65 +3,87 @@
 Извлечено из ai_agent.py.
 """
 
-import json
 import logging
+import random
 import time as _time
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 
 import db
 from config import OPENROUTER_API_KEY, AI_MODEL
 
-from .prompts import build_system_prompt, append_client_context
-from .tools import TOOLS_ADMIN, TOOLS_CLIENT
+from .prompts import build_system_prompt, build_time_context, append_client_context
+from .tools import TOOLS_ADMIN, TOOLS_CLIENT, TOOLS_ADMIN_JSON, TOOLS_CLIENT_JSON
 from .functions import execute_function
+from . import validator
 from .notifications import notify_admin_api_down
 
 logger = logging.getLogger(__name__)
 
 OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 
+# Лимиты окна истории (символы): режем только при HARD_CAP, и сразу до SOFT_CAP
+SOFT_CAP_CHARS = 16000
+HARD_CAP_CHARS = 28000
+
+# Общая HTTP-сессия: TCP+TLS соединение с OpenRouter переиспользуется между запросами
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=0))
+_SESSION.headers.update({
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "Content-Type": "application/json",
+    "Connection": "keep-alive",
+})
+
 
 def process_message(phone: str, user_message: str, source: str = "whatsapp") -> str:
     """
     Принимает номер и текст сообщения.
     Возвращает текстовый ответ от AI-агента.
     """
-    # Убедимся, что клиент есть в БД
-    if not db.get_client(phone):
-        db.create_client(phone)
-
-    # Сохраняем входящее сообщение
-    db.save_message(phone, "user", user_message)
-
-    # Загружаем весь контекст за одно соединение
-    ctx = db.get_client_context(phone)
+    # Клиент (upsert) + входящее сообщение + весь контекст — одна транзакция
+    ctx = db.begin_turn(phone, user_message)
     admin = ctx["is_admin"]
 
     logger.info(f"Processing message: phone={phone}, is_admin={admin}, source={source}")
 
-    # Собираем системный промпт + контекст клиента
+    # Одно «сейчас» на весь ход: промпт и все вызовы функций видят одинаковое время
+    now = validator.now_local()
+
+    # Системный промпт — статичный префикс (кэшируется провайдером), вместе с правилами режима админа.
+    # В хвостовом сообщении только динамика: дата/время, имя/телефон админа или данные клиента.
     system_prompt = build_system_prompt(phone, admin)
-    system_prompt = append_client_context(system_prompt, ctx, phone, admin)
+    client_context = append_client_context(build_time_context(now), ctx, phone, admin).strip()
 
     tools = TOOLS_ADMIN if admin else TOOLS_CLIENT
+    tools_json = TOOLS_ADMIN_JSON if admin else TOOLS_CLIENT_JSON
     logger.info(f"Tools count: {len(tools)} ({'ADMIN' if admin else 'CLIENT'})")
 
+    # Защита от переполнения контекста (~1 токен = 2 символа для русского).
+    # Окно истории только растёт; при превышении HARD_CAP режем пачкой до SOFT_CAP
+    # и сохраняем новую точку отсечения — между сбросами префикс не меняется.
+    history = ctx["chat_history"]
+    window_start_id = None
+    lens = [len(m["message"]) for m in history]
+    fixed_chars = len(system_prompt) + len(client_context)
+    if history and fixed_chars + sum(lens) > HARD_CAP_CHARS:
+        cut = _window_cut(lens, SOFT_CAP_CHARS - fixed_chars)
+        history = history[cut:]
+        window_start_id = history[0]["id"]  # сохраняется в end_turn
+        logger.info(f"Context window reset: dropped {cut} messages")
+
     # Формируем messages для API
     messages = [{"role": "system", "content": system_prompt}]
-    for msg in ctx["chat_history"]:
-        messages.append({"role": msg["role"], "content": msg["message"]})
+    messages.extend({"role": msg["role"], "content": msg["message"]} for msg in history)
 
-    # Защита от переполнения контекста (~1 токен = 2 символа для русского)
-    MAX_CONTEXT_CHARS = 16000
-    total_chars = sum(len(m.get("content", "")) for m in messages)
-    while total_chars > MAX_CONTEXT_CHARS and len(messages) > 2:
-        removed = messages.pop(1)  # Удаляем старейшее (после system prompt)
-        total_chars -= len(removed.get("content", ""))
+    if client_context:
+        messages.append({"role": "system", "content": client_context})
 
     # Цикл function calling (максимум 5 итераций)
     for iteration in range(5):
-        response = _call_openrouter(messages, tools)
+        response = _call_openrouter(messages, tools_json)
 
         if not response:
             answer = "Извините, произошла техническая ошибка. Попробуйте написать ещё раз."
@@ -75,11 +97,11 @@ def process_message(phone: str, user_message: str, source: str = "whatsapp") ->
 
             for tool_call in choice["tool_calls"]:
                 func_name = tool_call["function"]["name"]
-                func_args = json.loads(tool_call["function"]["arguments"])
+                func_args = orjson.loads(tool_call["function"]["arguments"])
 
                 logger.info(f"AI calls: {func_name}({func_args})")
 
-                result = execute_function(func_name, func_args, phone, admin)
+                result = execute_function(func_name, func_args, phone, admin, now=now)
 
                 messages.append({
                     "role": "tool",
@@ -95,43 +117,81 @@ def process_message(phone: str, user_message: str, source: str = "whatsapp") ->
     else:
         answer = "Извините, не удалось обработать запрос. Попробуйте ещё раз."
 
-    # Сохраняем ответ в историю
-    db.save_message(phone, "assistant", answer)
+    # Сохраняем ответ (и новую точку окна истории) одной транзакцией
+    db.end_turn(phone, answer, window_start_id)
 
     return answer
 
 
-def _call_openrouter(messages: list, tools: list) -> dict | None:
+def _window_cut(lens: list[int], budget: int) -> int:
+    """Индекс первого сообщения окна: идём с конца, пока суммарная длина влезает в budget.
+    Последнее сообщение (текущий вопрос) остаётся всегда.
+    """
+    total = 0
+    cut = len(lens) - 1
+    for i in range(len(lens) - 1, -1, -1):
+        total += lens[i]
+        if total > budget and i < len(lens) - 1:
+            break
+        cut = i
+    return cut
+
+
+def _backoff_delay(attempt: int) -> float:
+    """Экспоненциальная задержка с jitter: ~0.5–1с, 1–2с — повторы не синхронизируются."""
+    return random.uniform(0.5, 1.0) * (2 ** attempt)
+
+
+def _body_prefix(tools_json: bytes) -> bytes:
+    """Неизменная часть тела запроса (модель + tools) — до массива messages."""
+    return (
+        b'{"model":' + orjson.dumps(AI_MODEL)
+        + b',"tools":' + tools_json
+        + b',"tool_choice":"auto","temperature":0.3,"stream":true,"messages":'
+    )
+
+
+# Собирается один раз при импорте; на каждом вызове дописываются только messages
+_BODY_PREFIXES = {
+    TOOLS_CLIENT_JSON: _body_prefix(TOOLS_CLIENT_JSON),
+    TOOLS_ADMIN_JSON: _body_prefix(TOOLS_ADMIN_JSON),
+}
+
+
+def _request_body(messages: list, tools_json: bytes) -> bytes:
+    prefix = _BODY_PREFIXES.get(tools_json) or _body_prefix(tools_json)
+    return prefix + orjson.dumps(messages) + b"}"
+
+
+def _call_openrouter(messages: list, tools_json: bytes) -> dict | None:
     """Вызвать OpenRouter API с retry и уведомлением админа при отказе."""
     for attempt in range(3):
         try:
-            resp = requests.post(
+            resp = _SESSION.post(
                 OPENROUTER_URL,
-                headers={
-                    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                    "Content-Type": "application/json",
-                },
-                json={
-                    "model": AI_MODEL,
-                    "messages": messages,
-                    "tools": tools,
-                    "tool_choice": "auto",
-                    "temperature": 0.3,
-                },
+                data=_request_body(messages, tools_json),
                 timeout=30,
+                stream=True,
             )
-            resp.raise_for_status()
-            return resp.json()
+            with resp:
+                resp.raise_for_status()
+                return _read_stream(resp)
 
         except requests.exceptions.Timeout:
             logger.warning(f"OpenRouter timeout (attempt {attempt + 1}/3)")
             if attempt < 2:
-                _time.sleep(2)
+                _time.sleep(_backoff_delay(attempt))
+                continue
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            # Обрыв или таймаут чтения посреди потока (iter_lines оборачивает их так)
+            logger.warning(f"OpenRouter stream interrupted (attempt {attempt + 1}/3): {e}")
+            if attempt < 2:
+                _time.sleep(_backoff_delay(attempt))
                 continue
         except requests.exceptions.HTTPError as e:
             logger.error(f"OpenRouter HTTP error: {e}")
             if attempt < 2 and e.response is not None and e.response.status_code >= 500:
-                _time.sleep(2)
+                _time.sleep(_backoff_delay(attempt))
                 continue
             break
         except Exception as e:
@@ -141,3 +201,55 @@ def _call_openrouter(messages: list, tools: list) -> dict | None:
     # Все попытки исчерпаны — уведомить админа
     notify_admin_api_down()
     return None
+
+
+def _read_stream(resp) -> dict:
+    """Собрать SSE-поток OpenRouter в ответ того же вида, что и без стриминга.
+    После finish_reason кадры не разбираем, но дочитываем поток до конца:
+    недочитанное соединение закрывается, а не возвращается в пул сессии.
+    """
+    content_parts = []
+    tool_calls = {}
+    finished = False
+
+    for raw in resp.iter_lines():
+        # Пустые строки — разделители кадров, ":..." — keep-alive комментарии
+        if finished or not raw or raw.startswith(b":"):
+            continue
+        if not raw.startswith(b"data:"):
+            continue
+        data = raw[5:].strip()
+        if data == b"[DONE]":
+            finished = True
+            continue
+
+        chunk = orjson.loads(data)
+        if "error" in chunk:
+            raise RuntimeError(f"stream error: {chunk['error']}")
+        if not chunk.get("choices"):
+            continue
+
+        choice = chunk["choices"][0]
+        delta = choice.get("delta") or {}
+        if delta.get("content"):
+            content_parts.append(delta["content"])
+        for tc in delta.get("tool_calls") or []:
+            call = tool_calls.setdefault(tc.get("index", 0), {
+                "id": None, "type": "function",
+                "function": {"name": "", "arguments": ""},
+            })
+            if tc.get("id"):
+                call["id"] = tc["id"]
+            fn = tc.get("function") or {}
+            if fn.get("name"):
+                call["function"]["name"] += fn["name"]
+            if fn.get("arguments"):
+                call["function"]["arguments"] += fn["arguments"]
+
+        if choice.get("finish_reason"):
+            finished = True
+
+    message = {"role": "assistant", "content": "".join(content_parts)}
+    if tool_calls:
+        message["tool_calls"] = [tool_calls[i] for i in sorted(tool_calls)]
+    return {"choices": [{"message": message}]}
@@ -5,87 +5,194 @@
 """
 
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 
 import db
+import telegram_db
 from transports import get_transport
 
 logger = logging.getLogger(__name__)
 
+# Пул для рассылки (создаётся лениво, переиспользуется между уведомлениями)
+_SEND_POOL_SIZE = 16
+_send_pool = None
+_send_pool_lock = threading.Lock()
+
+
+def _get_send_pool() -> ThreadPoolExecutor:
+    global _send_pool
+    if _send_pool is None:
+        with _send_pool_lock:
+            if _send_pool is None:
+                _send_pool = ThreadPoolExecutor(max_workers=_SEND_POOL_SIZE, thread_name_prefix="notify")
+    return _send_pool
+
+
+# ==================== Шаблоны сообщений ====================
+
+_MSG_ADMIN_NEW_APPT = (
+    "📌 *Новая запись!*\n\n"
+    "Клиент: {a.client_name}\n"
+    "Тел: {a.client_phone}\n"
+    "Врач: {a.doctor_name}\n"
+    "Услуга: {a.service_name}\n"
+    "Дата: {a.appointment_date}\n"
+    "Время: {a.time_str}\n"
+    "Цена: {a.price} ₸"
+)
+
+_MSG_ADMIN_CANCELLED = (
+    "❌ *Запись отменена*\n\n"
+    "Клиент: {a.client_name}\n"
+    "Было: {a.appointment_date} в {a.time_str}\n"
+    "Услуга: {a.service_name}"
+)
+
+_MSG_ADMIN_RESCHEDULED = (
+    "📅 *Запись перенесена*\n\n"
+    "Клиент: {a.client_name}\n"
+    "Тел: {a.client_phone}\n"
+    "Было: {was_date} в {was_time}\n"
+    "Стало: {new_date} в {new_time}\n"
+    "Услуга: {a.service_name}"
+)
+
+_MSG_PATIENT_CANCELLED = (
+    "Здравствуйте! Сообщаем, что ваша запись была отменена администратором.\n\n"
+    "📋 *Отменённая запись:*\n"
+    "Врач: {a.doctor_name}\n"
+    "Услуга: {a.service_name}\n"
+    "Дата: {a.appointment_date}\n"
+    "Время: {a.time_str}\n\n"
+    "Если хотите записаться на другое время — просто напишите нам!"
+)
+
+_MSG_PATIENT_RESCHEDULED = (
+    "Здравствуйте! Сообщаем, что ваша запись была перенесена.\n\n"
+    "📋 *Было:* {was_date} в {was_time}\n"
+    "📋 *Стало:* {new_date} в {new_time}\n"
+    "Врач: {a.doctor_name}\n"
+    "Услуга: {a.service_name}\n\n"
+    "Если это время вам не подходит — напишите нам, и мы подберём другое!"
+)
+
+
+@dataclass(slots=True, frozen=True)
+class AppointmentNotice:
+    """Поля записи для шаблонов уведомлений: пустые → «—», время уже в HH:MM."""
+    client_name: object = "—"
+    client_phone: object = "—"
+    doctor_name: object = "—"
+    service_name: object = "—"
+    appointment_date: object = "—"
+    time_str: str = ""
+    price: object = "—"
+
+    @classmethod
+    def from_row(cls, appt: dict) -> "AppointmentNotice":
+        def val(key):
+            v = appt.get(key)
+            return "—" if v is None else v
+        return cls(
+            client_name=val("client_name"),
+            client_phone=val("client_phone"),
+            doctor_name=val("doctor_name"),
+            service_name=val("service_name"),
+            appointment_date=val("appointment_date"),
+            time_str=str(appt.get("appointment_time", ""))[:5],
+            price=val("price"),
+        )
+
+
+def _reschedule_fields(new_date, new_time, old_date, old_time) -> dict:
+    return {
+        "was_date": old_date or "—",
+        "was_time": str(old_time or "—")[:5],
+        "new_date": new_date,
+        "new_time": str(new_time)[:5],
+    }
 
-def _send_to_phone(phone: str, msg: str):
-    """Отправить сообщение по номеру телефона через ВСЕ доступные каналы (WhatsApp + Telegram)."""
-    # WhatsApp — основной канал
-    try:
-        get_transport("whatsapp").send_message(phone, msg)
-    except Exception as e:
-        logger.error(f"WhatsApp send error for {phone}: {e}")
 
+def _send_to_phone(phone: str, msg: str):
+    """Отправить сообщение по номеру телефона через ВСЕ доступные каналы (WhatsApp + Telegram).
+    Telegram уходит в event loop бота сразу, WhatsApp отправляется параллельно в этом потоке.
+    """
     # Telegram — дополнительный канал (если пользователь привязал аккаунт)
+    tg_future = None
     try:
-        import telegram_db
         chat_id = telegram_db.get_telegram_chat_id(phone)
         if chat_id:
-            get_transport("telegram").send_to_chat(chat_id, msg)
+            tg_future = get_transport("telegram").submit_to_chat(chat_id, msg)
+        else:
+            logger.debug("Telegram send skipped for %s: no chat linked", phone)
     except Exception as e:
-        logger.debug(f"Telegram send skipped for {phone}: {e}")
+        logger.error("Telegram send error for %s: %s", phone, e)
 
-
-def send_to_all_admins(msg: str, exclude_phone: str = None):
-    """Отправить сообщение всем активным админам через все каналы."""
-    admin_phones = db.get_all_admin_phones()
-    for phone in admin_phones:
-        if phone != exclude_phone:
-            _send_to_phone(phone, msg)
+    # WhatsApp — основной канал
+    try:
+        get_transport("whatsapp").send_message(phone, msg)
+    except Exception as e:
+        logger.error("WhatsApp send error for %s: %s", phone, e)
+
+    if tg_future is not None:
+        try:
+            tg_future.result(timeout=10)
+        except Exception as e:
+            logger.error("Telegram send error for %s: %s", phone, e)
+
+
+def send_to_all_admins(msg: str, exclude_phone: str = None, admin_phones: frozenset[str] = None):
+    """Отправить сообщение всем активным админам через все каналы.
+    admin_phones — уже загруженный набор (для пакетных рассылок), иначе из кэша db.
+    """
+    if admin_phones is None:
+        admin_phones = db.get_all_admin_phones()
+    phones = frozenset(admin_phones) - {exclude_phone}
+    if not phones:
+        return
+    if len(phones) == 1:
+        _send_to_phone(next(iter(phones)), msg)
+        return
+    # Параллельно: время рассылки ≈ одна самая медленная отправка, а не сумма.
+    # _send_to_phone сам ловит ошибки — один сбой не прерывает остальных.
+    list(_get_send_pool().map(lambda p: _send_to_phone(p, msg), phones))
 
 
 def notify_admin_new_appointment(appt: dict, exclude_phone: str = None):
     """Уведомить всех админов о новой записи."""
-    msg = (
-        f"📌 *Новая запись!*\n\n"
-        f"Клиент: {appt.get('client_name', '—')}\n"
-        f"Тел: {appt.get('client_phone', '—')}\n"
-        f"Врач: {appt.get('doctor_name', '—')}\n"
-        f"Услуга: {appt.get('service_name', '—')}\n"
-        f"Дата: {appt.get('appointment_date')}\n"
-        f"Время: {str(appt.get('appointment_time', ''))[:5]}\n"
-        f"Цена: {appt.get('price', '—')} ₸"
-    )
+    msg = _MSG_ADMIN_NEW_APPT.format(a=AppointmentNotice.from_row(appt))
     send_to_all_admins(msg, exclude_phone=exclude_phone)
 
 
-def notify_admin_cancellation(appointment_id: int, exclude_phone: str = None, reason: str = None):
-    """Уведомить всех админов об отмене."""
-    appt = db.get_appointment_by_id(appointment_id)
+def notify_admin_cancellation(appointment_id: int, exclude_phone: str = None, reason: str = None,
+                              appt: dict = None):
+    """Уведомить всех админов об отмене.
+    appt — уже загруженная запись (с client_name/service_name), иначе читается из БД.
+    """
+    if appt is None:
+        appt = db.get_appointment_by_id(appointment_id)
     if not appt:
         return
     # Причина: из аргумента или из БД
     cancel_reason = reason or appt.get("cancellation_reason")
-    msg = (
-        f"❌ *Запись отменена*\n\n"
-        f"Клиент: {appt.get('client_name', '—')}\n"
-        f"Было: {appt.get('appointment_date')} в {str(appt.get('appointment_time', ''))[:5]}\n"
-        f"Услуга: {appt.get('service_name', '—')}"
-    )
+    msg = _MSG_ADMIN_CANCELLED.format(a=AppointmentNotice.from_row(appt))
     if cancel_reason:
         msg += f"\nПричина: {cancel_reason}"
     send_to_all_admins(msg, exclude_phone=exclude_phone)
 
 
-def notify_admin_reschedule(appointment_id: int, new_date, new_time, old_date=None, old_time=None, exclude_phone: str = None):
+def notify_admin_reschedule(appointment_id: int, new_date, new_time, old_date=None, old_time=None,
+                            exclude_phone: str = None, appt: dict = None):
     """Уведомить всех админов о переносе."""
-    appt = db.get_appointment_by_id(appointment_id)
+    if appt is None:
+        appt = db.get_appointment_by_id(appointment_id)
     if not appt:
         return
-    was_date = old_date or "—"
-    was_time = str(old_time or "—")[:5]
-    msg = (
-        f"📅 *Запись перенесена*\n\n"
-        f"Клиент: {appt.get('client_name', '—')}\n"
-        f"Тел: {appt.get('client_phone', '—')}\n"
-        f"Было: {was_date} в {was_time}\n"
-        f"Стало: {new_date} в {str(new_time)[:5]}\n"
-        f"Услуга: {appt.get('service_name', '—')}"
-    )
+    msg = _MSG_ADMIN_RESCHEDULED.format(
+        a=AppointmentNotice.from_row(appt), **_reschedule_fields(new_date, new_time, old_date, old_time))
     send_to_all_admins(msg, exclude_phone=exclude_phone)
 
 
@@ -94,41 +201,40 @@ def notify_patient_cancellation(appt: dict):
     patient_phone = appt.get("client_phone")
     if not patient_phone:
         return
-    msg = (
-        f"Здравствуйте! Сообщаем, что ваша запись была отменена администратором.\n\n"
-        f"📋 *Отменённая запись:*\n"
-        f"Врач: {appt.get('doctor_name', '—')}\n"
-        f"Услуга: {appt.get('service_name', '—')}\n"
-        f"Дата: {appt.get('appointment_date')}\n"
-        f"Время: {str(appt.get('appointment_time', ''))[:5]}\n\n"
-        f"Если хотите записаться на другое время — просто напишите нам!"
-    )
+    msg = _MSG_PATIENT_CANCELLED.format(a=AppointmentNotice.from_row(appt))
     _send_to_phone(patient_phone, msg)
 
 
-def notify_patient_reschedule(appointment_id: int, new_date, new_time, old_date=None, old_time=None):
+def notify_patient_reschedule(appointment_id: int, new_date, new_time, old_date=None, old_time=None,
+                              appt: dict = None):
     """Уведомить пациента что админ перенёс его запись."""
-    appt = db.get_appointment_by_id(appointment_id)
+    if appt is None:
+        appt = db.get_appointment_by_id(appointment_id)
     if not appt:
         return
     patient_phone = appt.get("client_phone")
     if not patient_phone:
         return
-    was_date = old_date or "—"
-    was_time = str(old_time or "—")[:5]
-    msg = (
-        f"Здравствуйте! Сообщаем, что ваша запись была перенесена.\n\n"
-        f"📋 *Было:* {was_date} в {was_time}\n"
-        f"📋 *Стало:* {new_date} в {str(new_time)[:5]}\n"
-        f"Врач: {appt.get('doctor_name', '—')}\n"
-        f"Услуга: {appt.get('service_name', '—')}\n\n"
-        f"Если это время вам не подходит — напишите нам, и мы подберём другое!"
-    )
+    msg = _MSG_PATIENT_RESCHEDULED.format(
+        a=AppointmentNotice.from_row(appt), **_reschedule_fields(new_date, new_time, old_date, old_time))
     _send_to_phone(patient_phone, msg)
 
 
+# Не чаще раза в 5 минут: при отказе API каждое входящее сообщение заканчивается здесь
+API_DOWN_COOLDOWN = 300
+_api_down_last = 0.0
+_api_down_lock = threading.Lock()
+
+
 def notify_admin_api_down():
-    """Уведомить всех админов что AI-сервис недоступен."""
+    """Уведомить всех админов что AI-сервис недоступен (с ограничением частоты)."""
+    global _api_down_last
+    with _api_down_lock:
+        now = time.monotonic()
+        if _api_down_last and now - _api_down_last < API_DOWN_COOLDOWN:
+            logger.debug("API-down alert suppressed (cooldown)")
+            return
+        _api_down_last = now
     try:
         send_to_all_admins(
             "⚠️ *ВНИМАНИЕ:* AI-сервис (OpenRouter) недоступен.\n"
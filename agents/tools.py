@@ -3,6 +3,8 @@
 Извлечено из ai_agent.py без изменений.
 """
 
+import orjson
+
 TOOLS_CLIENT = [
     {
         "type": "function",
@@ -299,3 +301,7 @@ TOOLS_ADMIN = TOOLS_CLIENT + [
         },
     },
 ]
+
+# Схемы статичны — сериализуем один раз при импорте и вклеиваем в тело запроса как есть
+TOOLS_CLIENT_JSON = orjson.dumps(TOOLS_CLIENT)
+TOOLS_ADMIN_JSON = orjson.dumps(TOOLS_ADMIN)
@@ -5,103 +5,104 @@
 
 import logging
 from datetime import date, time, datetime, timedelta
-
-import pytz
+from zoneinfo import ZoneInfo
 
 from config import TIMEZONE
 
 logger = logging.getLogger(__name__)
 
+_TZ = ZoneInfo(TIMEZONE)
+_HORIZON = timedelta(days=60)  # горизонт записи
 
-def validate_appointment_time(appt_date: date, appt_time: time) -> dict:
-    """Валидация даты и времени записи.
 
-    Returns:
-        {"valid": bool, "error": str | None, "corrected_time": time | None}
-    """
-    tz = pytz.timezone(TIMEZONE)
-    now_local = datetime.now(tz).replace(tzinfo=None)
+_APPOINTMENT_MSGS = {
+    "past": "Невозможно записаться на прошедшую дату/время. Пожалуйста, выберите будущую дату.",
+    "too_far": "Запись возможна максимум на 60 дней вперёд.",
+    "bad_minute": "Время {time} некорректно. Записи принимаются строго на :00 или :30 минут (например 15:00 или 15:30).",
+    "log": "Time rounded from %s to %02d:%02d",
+}
 
-    # Дата/время не в прошлом
-    appt_datetime = datetime.combine(appt_date, appt_time)
-    if appt_datetime < now_local:
-        return {"valid": False, "error": "Невозможно записаться на прошедшую дату/время. Пожалуйста, выберите будущую дату.", "corrected_time": None}
+_RESCHEDULE_MSGS = {
+    "past": "Невозможно перенести на прошедшую дату/время. Выберите будущую дату.",
+    "too_far": "Перенос возможен максимум на 60 дней вперёд.",
+    "bad_minute": "Время {time} некорректно. Записи принимаются строго на :00 или :30 минут.",
+    "log": "Reschedule time rounded from %s to %02d:%02d",
+}
 
-    # Не дальше 60 дней
-    if appt_date > (now_local + timedelta(days=60)).date():
-        return {"valid": False, "error": "Запись возможна максимум на 60 дней вперёд.", "corrected_time": None}
 
-    # Время должно быть на 30-минутных интервалах
-    corrected_time = None
-    if appt_time.minute not in (0, 30):
-        original_time_str = appt_time.strftime('%H:%M')
-        if appt_time.minute < 15:
-            corrected_time = time(appt_time.hour, 0)
-        elif appt_time.minute < 45:
-            corrected_time = time(appt_time.hour, 30)
-        else:
-            new_hour = appt_time.hour + 1
-            if new_hour >= 18:
-                return {
-                    "valid": False,
-                    "error": f"Время {original_time_str} некорректно. Записи принимаются строго на :00 или :30 минут (например 15:00 или 15:30).",
-                    "corrected_time": None,
-                }
-            corrected_time = time(new_hour, 0)
-        logger.info(f"Time rounded from {original_time_str} to {corrected_time.strftime('%H:%M')}")
+def validate_appointment_time(appt_date: date, appt_time: time, *, now: datetime | None = None) -> dict:
+    """Валидация даты и времени записи.
+    now — локальное «сейчас» хода диалога (naive); если не передано — берётся текущее.
 
-    return {"valid": True, "error": None, "corrected_time": corrected_time}
+    Returns:
+        {"valid": bool, "error": str | None, "corrected_time": time | None}
+    """
+    return _validate_slot(appt_date, appt_time, _APPOINTMENT_MSGS, now)
 
 
-def validate_reschedule_time(new_date: date, new_time: time) -> dict:
+def validate_reschedule_time(new_date: date, new_time: time, *, now: datetime | None = None) -> dict:
     """Валидация даты/времени для переноса записи.
 
     Returns:
         {"valid": bool, "error": str | None, "corrected_time": time | None}
     """
-    tz = pytz.timezone(TIMEZONE)
-    now_local = datetime.now(tz).replace(tzinfo=None)
+    return _validate_slot(new_date, new_time, _RESCHEDULE_MSGS, now)
+
+
+def now_local() -> datetime:
+    """Текущее локальное время клиники (naive)."""
+    return datetime.now(_TZ).replace(tzinfo=None)
 
-    new_datetime = datetime.combine(new_date, new_time)
-    if new_datetime < now_local:
-        return {"valid": False, "error": "Невозможно перенести на прошедшую дату/время. Выберите будущую дату.", "corrected_time": None}
 
-    if new_date > (now_local + timedelta(days=60)).date():
-        return {"valid": False, "error": "Перенос возможен максимум на 60 дней вперёд.", "corrected_time": None}
+def _validate_slot(d: date, t: time, msgs: dict, now: datetime | None = None) -> dict:
+    """Общая проверка слота: не в прошлом, не дальше 60 дней, округление до :00/:30."""
+    if now is None:
+        now = now_local()
+
+    # Дата/время не в прошлом
+    if datetime.combine(d, t) < now:
+        return {"valid": False, "error": msgs["past"], "corrected_time": None}
+
+    # Не дальше 60 дней (чистая арифметика дат, без промежуточного datetime)
+    if d > now.date() + _HORIZON:
+        return {"valid": False, "error": msgs["too_far"], "corrected_time": None}
 
-    # Время на 30-минутных интервалах (как в validate_appointment_time)
+    # Время должно быть на 30-минутных интервалах
     corrected_time = None
-    if new_time.minute not in (0, 30):
-        original_time_str = new_time.strftime('%H:%M')
-        if new_time.minute < 15:
-            corrected_time = time(new_time.hour, 0)
-        elif new_time.minute < 45:
-            corrected_time = time(new_time.hour, 30)
-        else:
-            new_hour = new_time.hour + 1
-            if new_hour >= 18:
-                return {
-                    "valid": False,
-                    "error": f"Время {original_time_str} некорректно. Записи принимаются строго на :00 или :30 минут.",
-                    "corrected_time": None,
-                }
-            corrected_time = time(new_hour, 0)
-        logger.info(f"Reschedule time rounded from {original_time_str} to {corrected_time.strftime('%H:%M')}")
+    if t.minute not in (0, 30):
+        original_time_str = t.strftime('%H:%M')
+        # Ближайшие :00/:30 (:15 → :30, :45 → следующий час)
+        new_hour, new_min = divmod(((t.hour * 60 + t.minute + 15) // 30) * 30, 60)
+        if new_hour > t.hour and new_hour >= 18:
+            return {
+                "valid": False,
+                "error": msgs["bad_minute"].format(time=original_time_str),
+                "corrected_time": None,
+            }
+        corrected_time = time(new_hour, new_min)
+        logger.info(msgs["log"], original_time_str, new_hour, new_min)
 
     return {"valid": True, "error": None, "corrected_time": corrected_time}
 
 
-def find_doctor_by_name(doctor_name: str, doctors: list) -> dict | None:
-    """Найти врача по имени (нечёткий поиск)."""
-    for d in doctors:
-        if doctor_name.lower() in d["name"].lower() or d["name"].lower() in doctor_name.lower():
-            return d
-    return None
+def find_doctor_by_name(doctor_name: str, doctors: list, names_lower: list = None) -> dict | None:
+    """Найти врача по имени (нечёткий поиск).
+    names_lower — заранее приведённые к нижнему регистру имена (в том же порядке).
+    """
+    return _find_by_name(doctor_name, doctors, names_lower)
 
 
-def find_service_by_name(service_name: str, services: list) -> dict | None:
+def find_service_by_name(service_name: str, services: list, names_lower: list = None) -> dict | None:
     """Найти услугу по названию (нечёткий поиск)."""
-    for s in services:
-        if service_name.lower() in s["name"].lower() or s["name"].lower() in service_name.lower():
-            return s
+    return _find_by_name(service_name, services, names_lower)
+
+
+def _find_by_name(query: str, records: list, names_lower: list = None) -> dict | None:
+    """Первая запись, где запрос входит в имя или имя входит в запрос (без учёта регистра)."""
+    q = query.lower()
+    if names_lower is None:
+        names_lower = [r["name"].lower() for r in records]
+    for record, name in zip(records, names_lower):
+        if q in name or name in q:
+            return record
     return None
@@ -6,11 +6,17 @@
 import psycopg2
 import psycopg2.extras
 import psycopg2.pool
+import ipaddress
 import logging
+import socket
+import threading
 from contextlib import contextmanager
-from datetime import date, time, datetime, timedelta
+from time import monotonic, sleep
+from datetime import date, time, timedelta
 
-from config import DB_CONFIG
+from config import (
+    DB_CONFIG, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_KEEPALIVE_INTERVAL, DB_IDLE_TX_TIMEOUT,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -18,44 +24,151 @@ logger = logging.getLogger(__name__)
 # ==================== Connection Pool ====================
 
 _pool = None
+_pool_lock = threading.Lock()
+# Очередь ожидания: ThreadedConnectionPool при исчерпании сразу кидает PoolError,
+# поэтому лишние потоки ждут слот здесь (как wait queue в psycopg_pool)
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_keepalive_thread = None
+
+
+class _Connection(psycopg2.extensions.connection):
+    """Соединение пула; помнит, какие запросы уже подготовлены (PREPARE) в его сессии."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def _connect_params() -> dict:
+    """Параметры подключения для пула: DNS-имя хоста резолвится один раз (hostaddr),
+    чтобы новые соединения пула не ходили в DNS. host остаётся — для проверки TLS.
+    При пересоздании пула адрес резолвится заново. Плюс серверные таймауты сессии.
+    """
+    params = dict(DB_CONFIG)
+    host = params.get("host") or ""
+    if host and not host.startswith("/") and "hostaddr" not in params:
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            try:
+                params["hostaddr"] = socket.getaddrinfo(host, params.get("port"), proto=socket.IPPROTO_TCP)[0][4][0]
+            except OSError as e:
+                logger.warning(f"DB host resolve failed, libpq will resolve itself: {e}")
+    # Забытая открытая транзакция держит блокировки — сервер сам закроет такую сессию
+    if DB_IDLE_TX_TIMEOUT > 0:
+        params["options"] = (
+            params.get("options", "") + f" -c idle_in_transaction_session_timeout={DB_IDLE_TX_TIMEOUT}s"
+        ).strip()
+    return params
 
 
 def _get_pool():
     """Получить или создать пул соединений (lazy init)."""
     global _pool
     if _pool is None or _pool.closed:
-        _pool = psycopg2.pool.ThreadedConnectionPool(
-            minconn=2,
-            maxconn=10,
-            **DB_CONFIG,
-        )
-        logger.info("Database connection pool created (min=2, max=10)")
+        with _pool_lock:
+            if _pool is None or _pool.closed:
+                _pool = psycopg2.pool.ThreadedConnectionPool(
+                    minconn=DB_POOL_MIN,
+                    maxconn=DB_POOL_MAX,
+                    connection_factory=_Connection,
+                    **_connect_params(),
+                )
+                logger.info(f"Database connection pool created (min={DB_POOL_MIN}, max={DB_POOL_MAX})")
+                _start_keepalive()
     return _pool
 
 
+def _start_keepalive():
+    """Запустить фоновый keepalive пула (один поток на процесс, переживает пересоздание пула)."""
+    global _keepalive_thread
+    if _keepalive_thread is None and DB_KEEPALIVE_INTERVAL > 0:
+        _keepalive_thread = threading.Thread(target=_keepalive_loop, name="db-keepalive", daemon=True)
+        _keepalive_thread.start()
+
+
+def _keepalive_loop():
+    while True:
+        sleep(DB_KEEPALIVE_INTERVAL)
+        try:
+            _ping_idle_connections()
+        except Exception:
+            logger.warning("DB keepalive failed", exc_info=True)
+
+
+def _ping_idle_connections():
+    """SELECT 1 на простаивающих соединениях: файрвол/сервер не рвёт их по таймауту,
+    а мёртвые заменяются свежими заранее — всплеск запросов не платит за TCP+TLS+auth.
+    Берутся только свободные слоты пула: рабочие запросы keepalive не ждут.
+    """
+    pool = _pool
+    if pool is None or pool.closed:
+        return
+    # Соединения, занятые запросами, и так живы — добираем до DB_POOL_MIN только простаивающие
+    want = DB_POOL_MIN - len(pool._used)
+    held = []
+    try:
+        while len(held) < want and _pool_slots.acquire(blocking=False):
+            try:
+                held.append(pool.getconn())
+            except Exception:
+                _pool_slots.release()
+                raise
+        for i, conn in enumerate(held):
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except (psycopg2.InterfaceError, psycopg2.OperationalError):
+                logger.info("DB keepalive: replacing dead connection")
+                held[i] = None
+                pool.putconn(conn, close=True)
+                held[i] = pool.getconn()
+    finally:
+        for conn in held:
+            try:
+                if conn is not None:
+                    pool.putconn(conn, close=bool(conn.closed))
+            finally:
+                _pool_slots.release()
+
+
 @contextmanager
-def get_conn():
+def get_conn(autocommit: bool = False):
     """Контекстный менеджер — берёт соединение из пула и возвращает обратно.
 
+    autocommit=True — для чтения одним SELECT: psycopg2 не шлёт BEGIN/COMMIT,
+    запрос идёт одним обменом с сервером вместо трёх. В пул соединение
+    возвращается снова в транзакционном режиме.
+
     Автоматически обнаруживает и заменяет «мёртвые» соединения (SSL drop,
     таймаут сервера).  Если соединение сломалось в момент работы — пул
     пересоздаётся, чтобы вычистить остальные устаревшие соединения.
     """
     global _pool
-    pool = _get_pool()
-    conn = pool.getconn()
-
-    # Если соединение уже закрыто на стороне клиента — отдаём его в утиль
-    # и берём свежее.
-    if conn.closed:
-        try:
-            pool.putconn(conn, close=True)
-        except Exception:
-            pass
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise psycopg2.pool.PoolError(f"connection pool exhausted (waited {DB_POOL_TIMEOUT}s)")
+    try:
+        pool = _get_pool()
         conn = pool.getconn()
 
+        # Если соединение уже закрыто на стороне клиента — отдаём его в утиль
+        # и берём свежее.
+        if conn.closed:
+            try:
+                pool.putconn(conn, close=True)
+            except Exception:
+                pass
+            conn = pool.getconn()
+    except BaseException:
+        _pool_slots.release()
+        raise
+
     returned = False
+    discard = False
     try:
+        if autocommit:
+            conn.autocommit = True
         yield conn
         conn.commit()
     except (psycopg2.InterfaceError, psycopg2.OperationalError):
@@ -77,11 +190,159 @@ def get_conn():
         try:
             conn.rollback()
         except Exception:
-            pass
+            # Откатить не удалось — состояние соединения неизвестно, в пул его не возвращаем
+            logger.warning("DB rollback failed, discarding connection", exc_info=True)
+            discard = True
         raise
     finally:
-        if not returned:
-            pool.putconn(conn)
+        try:
+            if not returned:
+                if autocommit and not conn.closed:
+                    try:
+                        conn.autocommit = False
+                    except Exception:
+                        discard = True
+                pool.putconn(conn, close=discard or bool(conn.closed))
+        finally:
+            _pool_slots.release()
+
+
+@contextmanager
+def advisory_lock(name: str):
+    """Сессионный advisory-lock Postgres по имени — одна задача на все инстансы.
+    yield True — lock взят (снимается на выходе), False — его держит другой процесс.
+    Соединение в autocommit: долгая задача не висит открытой транзакцией.
+    """
+    with get_conn(autocommit=True) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (name,))
+            acquired = cur.fetchone()[0]
+        try:
+            yield acquired
+        finally:
+            # Закрытое соединение (пул сброшен после ошибки в задаче) — сервер уже снял
+            # сессионный lock; ошибка самого unlock не должна подменять исходную
+            if acquired and not conn.closed:
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (name,))
+                except psycopg2.Error:
+                    logger.warning(f"Advisory unlock failed for {name}", exc_info=True)
+
+
+# Курсоры: все обычные запросы (клиент, услуга, расписание, списки до ~50 строк)
+# идут через безымянный conn.cursor() + fetchone/fetchall — один обмен с сервером.
+# Серверный (именованный) курсор — только для потоковых выгрузок больших диапазонов:
+# на маленьких выборках он добавляет DECLARE/FETCH/CLOSE и заметно медленнее.
+
+
+def _fetch_dicts(cur) -> list[dict]:
+    """Строки результата как обычные dict — дешевле, чем RealDictCursor на больших выборках."""
+    cols = [c.name for c in cur.description]
+    return [dict(zip(cols, row)) for row in cur]
+
+
+# ==================== Подготовленные запросы ====================
+
+# Запросы горячего пути (каждое сообщение): разбираются и планируются сервером
+# один раз на соединение, дальше — только EXECUTE.
+_PREPARED = {
+    "q_client_by_phone": "SELECT * FROM clients WHERE phone = $1",
+    "q_save_message": "INSERT INTO chat_history (phone, role, message) VALUES ($1, $2, $3)",
+    # Весь контекст клиента за один запрос ($1 — телефон, $2 — это ADMIN_PHONE из конфига).
+    # Окно истории: с сохранённой точки отсечения, иначе последние N сообщений —
+    # и тогда точка фиксируется (data-modifying CTE выполняется всегда).
+    "q_client_context": """
+        WITH c AS (
+            SELECT * FROM clients WHERE phone = $1
+        ),
+        adm AS (
+            SELECT $2::boolean OR EXISTS (
+                SELECT 1 FROM admin_users WHERE phone = $1 AND is_active = TRUE
+            ) AS is_admin
+        ),
+        visits AS (
+            SELECT a.appointment_date, a.status,
+                   d.name AS doctor_name, s.name AS service_name
+            FROM appointments a
+            JOIN c ON a.client_id = c.id
+            JOIN doctors d ON a.doctor_id = d.id
+            JOIN services s ON a.service_id = s.id
+            WHERE a.status IN ('completed', 'scheduled')
+            ORDER BY a.appointment_date DESC LIMIT 5
+        ),
+        upcoming AS (
+            SELECT a.id, a.appointment_date, a.appointment_time, a.status,
+                   d.name AS doctor_name, s.name AS service_name
+            FROM appointments a
+            JOIN c ON a.client_id = c.id
+            JOIN doctors d ON a.doctor_id = d.id
+            JOIN services s ON a.service_id = s.id
+            WHERE a.status = 'scheduled'
+                  AND (a.appointment_date > CURRENT_DATE
+                       OR (a.appointment_date = CURRENT_DATE AND a.appointment_time > CURRENT_TIME))
+        ),
+        chat AS (
+            SELECT h.id, h.role, h.message
+            FROM chat_history h JOIN c ON h.id >= c.chat_window_start_id
+            WHERE h.phone = $1
+            UNION ALL
+            SELECT * FROM (
+                SELECT h.id, h.role, h.message
+                FROM chat_history h
+                WHERE h.phone = $1
+                      AND NOT EXISTS (SELECT 1 FROM c WHERE c.chat_window_start_id IS NOT NULL)
+                ORDER BY h.id DESC
+                LIMIT CASE WHEN (SELECT is_admin FROM adm) THEN 20 ELSE 10 END
+            ) tail
+        ),
+        mark AS (
+            UPDATE clients SET chat_window_start_id = (SELECT min(id) FROM chat)
+            WHERE id = (SELECT id FROM c) AND chat_window_start_id IS NULL
+                  AND EXISTS (SELECT 1 FROM chat)
+        )
+        SELECT (SELECT row_to_json(c) FROM c) AS client,
+               (SELECT is_admin FROM adm) AS is_admin,
+               COALESCE((SELECT json_agg(v ORDER BY v.appointment_date DESC) FROM visits v), '[]')
+                   AS visit_history,
+               COALESCE((SELECT json_agg(u ORDER BY u.appointment_date, u.appointment_time) FROM upcoming u), '[]')
+                   AS upcoming,
+               COALESCE((SELECT json_agg(h ORDER BY h.id) FROM chat h), '[]') AS chat_history
+    """,
+}
+
+
+def _execute_prepared(cur, name: str, params: tuple):
+    """EXECUTE подготовленного запроса; при первом использовании на соединении — PREPARE.
+    PREPARE не откатывается вместе с транзакцией, поэтому отмечаем его сразу после успеха.
+    """
+    prepared = cur.connection.prepared
+    if name not in prepared:
+        cur.execute(f"PREPARE {name} AS {_PREPARED[name]}")
+        prepared.add(name)
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+
+# ==================== Кэш справочников ====================
+
+# Кэш (вид, ключ) → (значение, время загрузки) для редко меняющихся наборов,
+# которые читаются на каждое сообщение (админы, блок-лист).
+REFERENCE_CACHE_TTL = 300
+_reference_cache = {}
+
+
+def _cached_lookup(key: tuple, loader, ttl: float = REFERENCE_CACHE_TTL):
+    cached = _reference_cache.get(key)
+    if cached and monotonic() - cached[1] < ttl:
+        return cached[0]
+    value = loader()
+    _reference_cache[key] = (value, monotonic())
+    return value
+
+
+def invalidate_reference_cache():
+    """Сбросить кэш справочников (после изменений справочников)."""
+    _reference_cache.clear()
 
 
 # ==================== Клиенты ====================
@@ -90,7 +351,7 @@ def get_client(phone: str) -> dict | None:
     """Получить клиента по номеру телефона."""
     with get_conn() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute("SELECT * FROM clients WHERE phone = %s", (phone,))
+            _execute_prepared(cur, "q_client_by_phone", (phone,))
             return cur.fetchone()
 
 
@@ -98,11 +359,21 @@ def create_client(phone: str, name: str = None) -> dict:
     """Создать нового клиента."""
     with get_conn() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            # UPDATE только если имя действительно меняется — без лишней версии строки и WAL.
+            # Если обновлять нечего, RETURNING пуст — тогда отдаём существующую строку.
             cur.execute(
-                "INSERT INTO clients (phone, name) VALUES (%s, %s) "
-                "ON CONFLICT (phone) DO UPDATE SET name = COALESCE(EXCLUDED.name, clients.name) "
-                "RETURNING *",
-                (phone, name),
+                """
+                WITH upsert AS (
+                    INSERT INTO clients (phone, name) VALUES (%(phone)s, %(name)s)
+                    ON CONFLICT (phone) DO UPDATE SET name = EXCLUDED.name
+                    WHERE EXCLUDED.name IS NOT NULL AND clients.name IS DISTINCT FROM EXCLUDED.name
+                    RETURNING *
+                )
+                SELECT * FROM upsert
+                UNION ALL
+                SELECT * FROM clients WHERE phone = %(phone)s AND NOT EXISTS (SELECT 1 FROM upsert)
+                """,
+                {"phone": phone, "name": name},
             )
             return cur.fetchone()
 
@@ -142,7 +413,7 @@ def get_doctors() -> list[dict]:
 
 def get_doctor(doctor_id: int) -> dict | None:
     """Получить врача по ID."""
-    with get_conn() as conn:
+    with get_conn(autocommit=True) as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
             cur.execute("SELECT * FROM doctors WHERE id = %s AND is_active = TRUE", (doctor_id,))
             return cur.fetchone()
@@ -172,7 +443,7 @@ def get_services() -> list[dict]:
 
 def get_service(service_id: int) -> dict | None:
     """Получить услугу по ID."""
-    with get_conn() as conn:
+    with get_conn(autocommit=True) as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
             cur.execute("SELECT * FROM services WHERE id = %s AND is_active = TRUE", (service_id,))
             return cur.fetchone()
@@ -182,85 +453,73 @@ def get_service(service_id: int) -> dict | None:
 
 def get_appointments_by_date(target_date: date) -> list[dict]:
     """Получить все записи на конкретную дату."""
-    with get_conn() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+    with get_conn(autocommit=True) as conn:
+        with conn.cursor() as cur:
             cur.execute(
                 """
                 SELECT a.id, a.appointment_date, a.appointment_time, a.status, a.notes,
-                       c.name AS client_name, c.phone AS client_phone,
-                       d.name AS doctor_name, d.specialization,
-                       s.name AS service_name, s.price, s.duration_minutes
-                FROM appointments a
-                JOIN clients c ON a.client_id = c.id
-                JOIN doctors d ON a.doctor_id = d.id
-                JOIN services s ON a.service_id = s.id
+                       a.client_name, a.client_phone,
+                       a.doctor_name, a.specialization,
+                       a.service_name, a.price, a.duration_minutes
+                FROM v_appointments_full a
                 WHERE a.appointment_date = %s AND a.status = 'scheduled'
                 ORDER BY a.appointment_time
                 """,
                 (target_date,),
             )
-            return cur.fetchall()
+            return _fetch_dicts(cur)
+
+
+_APPOINTMENTS_RANGE_SQL = """
+    SELECT a.id, a.appointment_date, a.appointment_time, a.status, a.notes,
+           a.client_name, a.client_phone,
+           a.doctor_name, a.specialization,
+           a.service_name, a.price, a.duration_minutes
+    FROM v_appointments_full a
+    WHERE a.appointment_date BETWEEN %s AND %s
+    ORDER BY a.appointment_date, a.appointment_time
+"""
 
 
 def get_appointments_range(start_date: date, end_date: date) -> list[dict]:
-    """Получить записи за диапазон дат."""
-    with get_conn() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute(
-                """
-                SELECT a.id, a.appointment_date, a.appointment_time, a.status, a.notes,
-                       c.name AS client_name, c.phone AS client_phone,
-                       d.name AS doctor_name, d.specialization,
-                       s.name AS service_name, s.price, s.duration_minutes
-                FROM appointments a
-                JOIN clients c ON a.client_id = c.id
-                JOIN doctors d ON a.doctor_id = d.id
-                JOIN services s ON a.service_id = s.id
-                WHERE a.appointment_date BETWEEN %s AND %s
-                ORDER BY a.appointment_date, a.appointment_time
-                """,
-                (start_date, end_date),
-            )
-            return cur.fetchall()
+    """Получить записи за диапазон дат (короткие диапазоны — неделя и т.п.)."""
+    with get_conn(autocommit=True) as conn:
+        with conn.cursor() as cur:
+            cur.execute(_APPOINTMENTS_RANGE_SQL, (start_date, end_date))
+            return _fetch_dicts(cur)
 
 
 def get_client_appointments(phone: str) -> list[dict]:
     """Получить все предстоящие записи клиента."""
-    with get_conn() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+    with get_conn(autocommit=True) as conn:
+        with conn.cursor() as cur:
             cur.execute(
                 """
                 SELECT a.id, a.appointment_date, a.appointment_time, a.status, a.notes,
-                       d.name AS doctor_name, d.specialization,
-                       s.name AS service_name, s.price, s.duration_minutes
-                FROM appointments a
-                JOIN clients c ON a.client_id = c.id
-                JOIN doctors d ON a.doctor_id = d.id
-                JOIN services s ON a.service_id = s.id
-                WHERE c.phone = %s AND a.status = 'scheduled'
+                       a.doctor_name, a.specialization,
+                       a.service_name, a.price, a.duration_minutes
+                FROM v_appointments_full a
+                WHERE a.client_phone = %s AND a.status = 'scheduled'
                       AND (a.appointment_date > CURRENT_DATE
                            OR (a.appointment_date = CURRENT_DATE AND a.appointment_time > CURRENT_TIME))
                 ORDER BY a.appointment_date, a.appointment_time
                 """,
                 (phone,),
             )
-            return cur.fetchall()
+            return _fetch_dicts(cur)
 
 
 def get_all_upcoming_appointments() -> list[dict]:
     """Получить все предстоящие записи клиники (для админа)."""
-    with get_conn() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+    with get_conn(autocommit=True) as conn:
+        with conn.cursor() as cur:
             cur.execute(
                 """
                 SELECT a.id, a.appointment_date, a.appointment_time, a.status, a.notes,
-                       c.name AS client_name, c.phone AS client_phone,
-                       d.name AS doctor_name, d.specialization,
-                       s.name AS service_name, s.price, s.duration_minutes
-                FROM appointments a
-                JOIN clients c ON a.client_id = c.id
-                JOIN doctors d ON a.doctor_id = d.id
-                JOIN services s ON a.service_id = s.id
+                       a.client_name, a.client_phone,
+                       a.doctor_name, a.specialization,
+                       a.service_name, a.price, a.duration_minutes
+                FROM v_appointments_full a
                 WHERE a.status = 'scheduled'
                       AND (a.appointment_date > CURRENT_DATE
                            OR (a.appointment_date = CURRENT_DATE AND a.appointment_time > CURRENT_TIME))
@@ -268,28 +527,30 @@ def get_all_upcoming_appointments() -> list[dict]:
                 LIMIT 50
                 """
             )
-            return cur.fetchall()
+            return _fetch_dicts(cur)
 
 
 def get_client_history(phone: str) -> list[dict]:
     """Получить историю посещений клиента (прошлые записи)."""
-    with get_conn() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+    with get_conn(autocommit=True) as conn:
+        with conn.cursor() as cur:
             cur.execute(
                 """
                 SELECT a.id, a.appointment_date, a.appointment_time, a.status,
-                       d.name AS doctor_name, s.name AS service_name
-                FROM appointments a
-                JOIN clients c ON a.client_id = c.id
-                JOIN doctors d ON a.doctor_id = d.id
-                JOIN services s ON a.service_id = s.id
-                WHERE c.phone = %s AND a.status IN ('completed', 'scheduled')
+                       a.doctor_name, a.service_name
+                FROM v_appointments_full a
+                WHERE a.client_phone = %s AND a.status IN ('completed', 'scheduled')
                 ORDER BY a.appointment_date DESC
                 LIMIT 10
                 """,
                 (phone,),
             )
-            return cur.fetchall()
+            return _fetch_dicts(cur)
+
+
+def _lock_doctor_day(cur, doctor_id: int, day: date):
+    """Транзакционная блокировка «врач + дата»: параллельные записи к нему на этот день идут по очереди."""
+    cur.execute("SELECT pg_advisory_xact_lock(%s, %s)", (doctor_id, day.toordinal()))
 
 
 def create_appointment(
@@ -304,188 +565,143 @@ def create_appointment(
     """Создать новую запись. Возвращает данные записи или None при конфликте."""
     with get_conn() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            # Получаем client_id
-            cur.execute("SELECT id FROM clients WHERE phone = %s", (client_phone,))
-            client = cur.fetchone()
-            if not client:
-                return None
-
-            # Получаем длительность услуги
-            cur.execute("SELECT duration_minutes FROM services WHERE id = %s", (service_id,))
-            service = cur.fetchone()
-            if not service:
-                return None
-
-            # Блокируем строки врача на эту дату (защита от двойной записи)
-            cur.execute(
-                """
-                SELECT id FROM appointments
-                WHERE doctor_id = %s AND appointment_date = %s AND status = 'scheduled'
-                FOR UPDATE
-                """,
-                (doctor_id, appt_date),
-            )
-
-            # Проверяем конфликт времени у врача
-            duration = service["duration_minutes"]
-            cur.execute(
-                """
-                SELECT id FROM appointments
-                WHERE doctor_id = %s AND appointment_date = %s AND status = 'scheduled'
-                      AND appointment_time < (%s::time + make_interval(mins => %s))
-                      AND (%s::time < appointment_time + (
-                          SELECT make_interval(mins => s.duration_minutes)
-                          FROM services s WHERE s.id = appointments.service_id
-                      ))
-                """,
-                (doctor_id, appt_date, appt_time, int(duration), appt_time),
-            )
-            if cur.fetchone():
-                return None  # Конфликт — время занято
+            # Сериализуем запись к врачу на дату (защита от двойной записи).
+            # Отдельным запросом: следующий увидит всё, что закоммитили до получения блокировки.
+            _lock_doctor_day(cur, doctor_id, appt_date)
 
-            # Создаем запись
+            # Клиент, длительность услуги, проверка конфликта и вставка — одним запросом.
+            # Нет клиента/услуги или время занято → ни одной строки → None.
             cur.execute(
                 """
-                INSERT INTO appointments (client_id, doctor_id, service_id,
-                    appointment_date, appointment_time, notes, patient_name)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                RETURNING *
-                """,
-                (client["id"], doctor_id, service_id, appt_date, appt_time, notes, patient_name),
-            )
-            appt = cur.fetchone()
-
-            # Подгружаем полные данные для ответа
-            cur.execute(
-                """
-                SELECT a.id, a.appointment_date, a.appointment_time, a.status,
+                WITH ins AS (
+                    INSERT INTO appointments (client_id, doctor_id, service_id,
+                        appointment_date, appointment_time, duration_minutes, notes, patient_name)
+                    SELECT c.id, %(doctor_id)s, s.id, %(date)s, %(time)s, s.duration_minutes,
+                           %(notes)s, %(patient_name)s
+                    FROM clients c, services s
+                    WHERE c.phone = %(phone)s AND s.id = %(service_id)s
+                      AND NOT EXISTS (
+                          SELECT 1 FROM appointments a2
+                          WHERE a2.doctor_id = %(doctor_id)s AND a2.status = 'scheduled'
+                                AND a2.appt_range && tsrange(
+                                    %(date)s::date + %(time)s::time,
+                                    %(date)s::date + %(time)s::time + make_interval(mins => s.duration_minutes))
+                      )
+                    RETURNING *
+                )
+                SELECT ins.id, ins.appointment_date, ins.appointment_time, ins.status,
                        c.name AS client_name, c.phone AS client_phone,
                        d.name AS doctor_name, d.specialization,
                        s.name AS service_name, s.price, s.duration_minutes
-                FROM appointments a
-                JOIN clients c ON a.client_id = c.id
-                JOIN doctors d ON a.doctor_id = d.id
-                JOIN services s ON a.service_id = s.id
-                WHERE a.id = %s
+                FROM ins
+                JOIN clients c ON ins.client_id = c.id
+                JOIN doctors d ON ins.doctor_id = d.id
+                JOIN services s ON ins.service_id = s.id
                 """,
-                (appt["id"],),
+                {
+                    "phone": client_phone, "doctor_id": doctor_id, "service_id": service_id,
+                    "date": appt_date, "time": appt_time,
+                    "notes": notes, "patient_name": patient_name,
+                },
             )
             return cur.fetchone()
 
 
 def cancel_appointment(appointment_id: int, client_phone: str = None, reason: str = None) -> dict | None:
-    """Отменить запись. Если client_phone указан — проверяет принадлежность."""
+    """Отменить запись. Если client_phone указан — проверяет принадлежность.
+    Возвращает запись с данными клиента/врача/услуги (как get_appointment_by_id).
+    """
+    owner_filter = "AND c.phone = %s" if client_phone else ""
+    params = (reason, appointment_id, client_phone) if client_phone else (reason, appointment_id)
     with get_conn() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            if client_phone:
-                cur.execute(
-                    """
-                    UPDATE appointments SET status = 'cancelled',
-                           cancellation_reason = %s, updated_at = NOW()
-                    WHERE id = %s AND status = 'scheduled'
-                          AND client_id = (SELECT id FROM clients WHERE phone = %s)
-                    RETURNING *
-                    """,
-                    (reason, appointment_id, client_phone),
-                )
-            else:
-                cur.execute(
-                    """
-                    UPDATE appointments SET status = 'cancelled',
-                           cancellation_reason = %s, updated_at = NOW()
-                    WHERE id = %s AND status = 'scheduled'
-                    RETURNING *
-                    """,
-                    (reason, appointment_id),
-                )
+            cur.execute(
+                f"""
+                UPDATE appointments a SET status = 'cancelled',
+                       cancellation_reason = %s, updated_at = NOW()
+                FROM clients c, doctors d, services s
+                WHERE a.id = %s AND a.status = 'scheduled'
+                      AND c.id = a.client_id AND d.id = a.doctor_id AND s.id = a.service_id
+                      {owner_filter}
+                RETURNING a.*, c.name AS client_name, c.phone AS client_phone,
+                          d.name AS doctor_name, s.name AS service_name,
+                          s.price, s.duration_minutes
+                """,
+                params,
+            )
             return cur.fetchone()
 
 
 def reschedule_appointment(
     appointment_id: int, new_date: date, new_time: time, client_phone: str = None
 ) -> dict | None:
-    """Перенести запись на новую дату/время."""
+    """Перенести запись на новую дату/время.
+    Возвращает обновлённую запись с old_date/old_time и данными клиента/врача/услуги.
+    """
+    owner_filter = "AND c.phone = %s" if client_phone else ""
+    day_key = new_date.toordinal()  # тот же ключ, что и в _lock_doctor_day
+    params = (day_key, appointment_id, client_phone) if client_phone else (day_key, appointment_id)
     with get_conn() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            # Получаем текущую запись
-            if client_phone:
-                cur.execute(
-                    """
-                    SELECT a.*, s.duration_minutes FROM appointments a
-                    JOIN services s ON a.service_id = s.id
-                    WHERE a.id = %s AND a.status = 'scheduled'
-                          AND a.client_id = (SELECT id FROM clients WHERE phone = %s)
-                    """,
-                    (appointment_id, client_phone),
-                )
-            else:
-                cur.execute(
-                    """
-                    SELECT a.*, s.duration_minutes FROM appointments a
-                    JOIN services s ON a.service_id = s.id
-                    WHERE a.id = %s AND a.status = 'scheduled'
-                    """,
-                    (appointment_id,),
-                )
-            appt = cur.fetchone()
-            if not appt:
-                return None
-
-            # Блокируем строки врача на новую дату (защита от двойной записи)
-            cur.execute(
-                """
-                SELECT id FROM appointments
-                WHERE doctor_id = %s AND appointment_date = %s AND status = 'scheduled'
-                FOR UPDATE
-                """,
-                (appt["doctor_id"], new_date),
-            )
-
-            # Проверяем конфликт на новое время
+            # Текущая запись + блокировка врача на новую дату (защита от двойной записи)
             cur.execute(
-                """
-                SELECT id FROM appointments
-                WHERE doctor_id = %s AND appointment_date = %s AND status = 'scheduled'
-                      AND id != %s
-                      AND appointment_time < (%s::time + make_interval(mins => %s))
-                      AND (%s::time < appointment_time + (
-                          SELECT make_interval(mins => s.duration_minutes)
-                          FROM services s WHERE s.id = appointments.service_id
-                      ))
+                f"""
+                SELECT a.*, s.name AS service_name, s.price,
+                       c.name AS client_name, c.phone AS client_phone, d.name AS doctor_name,
+                       pg_advisory_xact_lock(a.doctor_id, %s) AS day_lock
+                FROM appointments a
+                JOIN services s ON a.service_id = s.id
+                JOIN clients c ON a.client_id = c.id
+                JOIN doctors d ON a.doctor_id = d.id
+                WHERE a.id = %s AND a.status = 'scheduled' {owner_filter}
                 """,
-                (appt["doctor_id"], new_date, appointment_id,
-                 new_time, int(appt["duration_minutes"]), new_time),
+                params,
             )
-            if cur.fetchone():
-                return {"error": "conflict"}  # Конфликт
-
-            # Сохраняем старые дату/время для уведомления
-            old_date = appt["appointment_date"]
-            old_time = appt["appointment_time"]
+            appt = cur.fetchone()
+            if not appt:
+                return None
 
+            # Перенос только если новое время свободно (проверка и UPDATE — один запрос)
             cur.execute(
                 """
                 UPDATE appointments
-                SET appointment_date = %s, appointment_time = %s,
+                SET appointment_date = %(date)s, appointment_time = %(time)s,
                     reminder_24h_sent = FALSE, reminder_2h_sent = FALSE,
                     updated_at = NOW()
-                WHERE id = %s
+                WHERE id = %(id)s
+                  AND NOT EXISTS (
+                      SELECT 1 FROM appointments a2
+                      WHERE a2.doctor_id = %(doctor_id)s AND a2.status = 'scheduled' AND a2.id != %(id)s
+                            AND a2.appt_range && tsrange(
+                                %(date)s::date + %(time)s::time,
+                                %(date)s::date + %(time)s::time + make_interval(mins => %(duration)s))
+                  )
                 RETURNING *
                 """,
-                (new_date, new_time, appointment_id),
+                {
+                    "id": appointment_id, "doctor_id": appt["doctor_id"],
+                    "date": new_date, "time": new_time, "duration": int(appt["duration_minutes"]),
+                },
             )
             updated = cur.fetchone()
-            if updated:
-                updated["old_date"] = old_date
-                updated["old_time"] = old_time
-            return updated
+
+    # Дальше только Python — транзакция (и блокировка врача) уже закрыты
+    if not updated:
+        return {"error": "conflict"}  # Конфликт
+
+    # Старые дата/время и данные для уведомлений — чтобы не перечитывать запись
+    updated["old_date"] = appt["appointment_date"]
+    updated["old_time"] = appt["appointment_time"]
+    for key in ("client_name", "client_phone", "doctor_name", "service_name", "price", "duration_minutes"):
+        updated[key] = appt[key]
+    return updated
 
 
 def get_doctor_schedule(doctor_id: int, day_of_week: int) -> dict | None:
     """Получить расписание врача на конкретный день недели (0=Пн, 6=Вс).
     Возвращает {'start_time': time, 'end_time': time} или None если не работает.
     """
-    with get_conn() as conn:
+    with get_conn(autocommit=True) as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
             cur.execute(
                 """
@@ -497,149 +713,54 @@ def get_doctor_schedule(doctor_id: int, day_of_week: int) -> dict | None:
             return cur.fetchone()
 
 
-def is_doctor_absent(doctor_id: int, target_date: date) -> bool:
-    """Проверить, отсутствует ли врач (болезнь/отпуск) на указанную дату."""
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT 1 FROM doctor_absences
-                WHERE doctor_id = %s AND start_date <= %s AND end_date >= %s
-                """,
-                (doctor_id, target_date, target_date),
-            )
-            return cur.fetchone() is not None
-
-
 def get_free_slots(target_date: date, doctor_id: int = None) -> list[dict]:
     """Получить свободные временные слоты на дату.
     Использует индивидуальное расписание врачей (doctor_schedules).
-    Если у врача нет записи в doctor_schedules — fallback на часы клиники.
+    Если у врача нет записи в doctor_schedules — fallback на часы клиники (clinic_hours).
     """
-    # Загружаем часы работы клиники (fallback)
-    try:
-        import google_config
-        clinic_hours = google_config.get_clinic_hours()
-    except Exception:
-        from config import CLINIC_HOURS
-        clinic_hours = CLINIC_HOURS
-
-    day_names_ru = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
     day_idx = target_date.weekday()
-    day_name = day_names_ru[day_idx]
-    clinic_hours_str = clinic_hours.get(day_name, "Выходной")
+    logger.info(f"get_free_slots: date={target_date}, day={day_idx}, doctor_id={doctor_id}")
 
-    logger.info(f"get_free_slots: date={target_date}, day={day_name}, clinic_hours={clinic_hours_str}, doctor_id={doctor_id}")
-
-    # Парсим дефолтные часы клиники
-    clinic_start_h, clinic_start_m = 9, 0
-    clinic_end_h, clinic_end_m = 18, 0
-    clinic_is_open = clinic_hours_str != "Выходной"
-    if clinic_is_open:
-        try:
-            start_str, end_str = clinic_hours_str.replace("–", "-").split("-")
-            clinic_start_h, clinic_start_m = map(int, start_str.strip().split(":"))
-            clinic_end_h, clinic_end_m = map(int, end_str.strip().split(":"))
-        except (ValueError, AttributeError):
-            pass
-
-    with get_conn() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            # Получаем занятые слоты
-            query = """
-                SELECT a.appointment_time, s.duration_minutes, d.name AS doctor_name, d.id AS doctor_id
-                FROM appointments a
-                JOIN services s ON a.service_id = s.id
-                JOIN doctors d ON a.doctor_id = d.id
-                WHERE a.appointment_date = %s AND a.status = 'scheduled'
-            """
-            params = [target_date]
-            if doctor_id:
-                query += " AND a.doctor_id = %s"
-                params.append(doctor_id)
-
-            cur.execute(query, params)
-            busy = cur.fetchall()
-
-            if busy:
-                logger.info(f"get_free_slots: found {len(busy)} busy appointments")
-            else:
-                logger.info(f"get_free_slots: no busy appointments found")
-
-            # Получаем врачей
-            if doctor_id:
-                cur.execute("SELECT id, name FROM doctors WHERE id = %s AND is_active = TRUE", (doctor_id,))
-            else:
-                cur.execute("SELECT id, name FROM doctors WHERE is_active = TRUE ORDER BY id")
-            doctors = cur.fetchall()
-
-            # Получаем индивидуальные расписания на этот день недели
-            cur.execute(
-                """
-                SELECT doctor_id, start_time, end_time FROM doctor_schedules
-                WHERE day_of_week = %s AND is_active = TRUE
-                """,
-                (day_idx,),
-            )
-            schedules = {row["doctor_id"]: row for row in cur.fetchall()}
-
-            # Получаем отсутствующих врачей на эту дату
+    # Слоты считает PostgreSQL одним запросом: рабочие часы врача (или часы клиники),
+    # generate_series по 30 минут и анти-join с занятыми записями
+    with get_conn(autocommit=True) as conn:
+        with conn.cursor() as cur:
             cur.execute(
                 """
-                SELECT DISTINCT doctor_id FROM doctor_absences
-                WHERE start_date <= %s AND end_date >= %s
+                WITH hours AS (
+                    SELECT d.id, d.name,
+                           %(day)s::date + COALESCE(sch.start_time, ch.start_time) AS day_start,
+                           %(day)s::date + COALESCE(sch.end_time, ch.end_time) AS day_end
+                    FROM doctors d
+                    LEFT JOIN doctor_schedules sch
+                        ON sch.doctor_id = d.id AND sch.day_of_week = %(dow)s AND sch.is_active = TRUE
+                    LEFT JOIN clinic_hours ch
+                        ON ch.day_of_week = %(dow)s AND ch.is_open = TRUE
+                    WHERE d.is_active = TRUE
+                      AND (%(doctor_id)s::int IS NULL OR d.id = %(doctor_id)s::int)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM doctor_absences ab
+                          WHERE ab.doctor_id = d.id AND ab.start_date <= %(day)s AND ab.end_date >= %(day)s
+                      )
+                )
+                SELECT h.id AS doctor_id, h.name AS doctor_name, to_char(gs.slot, 'HH24:MI') AS time
+                FROM hours h
+                CROSS JOIN LATERAL generate_series(h.day_start, h.day_end, interval '30 minutes') AS gs(slot)
+                WHERE gs.slot < h.day_end
+                  AND NOT EXISTS (
+                      SELECT 1 FROM appointments a
+                      WHERE a.doctor_id = h.id AND a.status = 'scheduled'
+                        AND a.appt_range && tsrange(gs.slot, gs.slot + interval '30 minutes')
+                  )
+                ORDER BY h.id, gs.slot
                 """,
-                (target_date, target_date),
+                {
+                    "day": target_date,
+                    "dow": day_idx,
+                    "doctor_id": doctor_id or None,
+                },
             )
-            absent_ids = {row["doctor_id"] for row in cur.fetchall()}
-
-    # Генерируем слоты по 30 минут для каждого врача
-    slots = []
-    for doc in doctors:
-        doc_id = doc["id"]
-
-        # Пропускаем отсутствующих врачей
-        if doc_id in absent_ids:
-            logger.info(f"get_free_slots: Dr. {doc['name']} absent on {target_date}")
-            continue
-
-        # Определяем рабочие часы врача
-        if doc_id in schedules:
-            sched = schedules[doc_id]
-            doc_start = sched["start_time"]
-            doc_end = sched["end_time"]
-        elif clinic_is_open:
-            doc_start = time(clinic_start_h, clinic_start_m)
-            doc_end = time(clinic_end_h, clinic_end_m)
-        else:
-            # Клиника закрыта и нет индивидуального расписания
-            continue
-
-        current = doc_start
-        while current < doc_end:
-            is_free = True
-            for b in busy:
-                if b["doctor_id"] != doc_id:
-                    continue
-                busy_start = b["appointment_time"]
-                busy_end_dt = datetime.combine(target_date, busy_start) + timedelta(minutes=b["duration_minutes"])
-                busy_end = busy_end_dt.time()
-                slot_end_dt = datetime.combine(target_date, current) + timedelta(minutes=30)
-                slot_end = slot_end_dt.time()
-
-                if not (slot_end <= busy_start or current >= busy_end):
-                    is_free = False
-                    break
-
-            if is_free:
-                slots.append({
-                    "doctor_id": doc_id,
-                    "doctor_name": doc["name"],
-                    "time": current.strftime("%H:%M"),
-                })
-
-            next_dt = datetime.combine(target_date, current) + timedelta(minutes=30)
-            current = next_dt.time()
+            slots = _fetch_dicts(cur)
 
     logger.info(f"get_free_slots: returning {len(slots)} free slots")
     return slots
@@ -661,39 +782,28 @@ def set_doctor_absence(doctor_id: int, start_date: date, end_date: date, reason:
             )
             absence_id = cur.fetchone()["id"]
 
-            # Находим затронутые записи (scheduled, в период отсутствия)
-            cur.execute(
-                """
-                SELECT a.id, a.appointment_date, a.appointment_time,
-                       c.phone AS client_phone, c.name AS client_name,
-                       s.name AS service_name, a.google_calendar_event_id
-                FROM appointments a
-                JOIN clients c ON a.client_id = c.id
-                JOIN services s ON a.service_id = s.id
-                WHERE a.doctor_id = %s AND a.status = 'scheduled'
-                      AND a.appointment_date BETWEEN %s AND %s
-                """,
-                (doctor_id, start_date, end_date),
-            )
-            affected = cur.fetchall()
-
-            # Массово отменяем
+            # Массово отменяем и сразу получаем затронутые записи (один проход)
             cur.execute(
                 """
-                UPDATE appointments SET status = 'cancelled',
+                UPDATE appointments a SET status = 'cancelled',
                        cancellation_reason = %s, updated_at = NOW()
-                WHERE doctor_id = %s AND status = 'scheduled'
-                      AND appointment_date BETWEEN %s AND %s
+                FROM clients c, services s
+                WHERE a.client_id = c.id AND a.service_id = s.id
+                      AND a.doctor_id = %s AND a.status = 'scheduled'
+                      AND a.appointment_date BETWEEN %s AND %s
+                RETURNING a.id, a.appointment_date, a.appointment_time,
+                          c.phone AS client_phone, c.name AS client_name,
+                          s.name AS service_name, s.price, a.google_calendar_event_id
                 """,
                 (f"Врач недоступен: {reason}", doctor_id, start_date, end_date),
             )
-            cancelled_count = cur.rowcount
+            affected = cur.fetchall()
 
-            return {
-                "absence_id": absence_id,
-                "cancelled_count": cancelled_count,
-                "affected_patients": affected,
-            }
+    return {
+        "absence_id": absence_id,
+        "cancelled_count": len(affected),
+        "affected_patients": affected,
+    }
 
 
 def update_appointment_calendar_id(appointment_id: int, event_id: str):
@@ -708,17 +818,11 @@ def update_appointment_calendar_id(appointment_id: int, event_id: str):
 
 def get_appointment_by_id(appointment_id: int) -> dict | None:
     """Получить запись по ID с полными данными."""
-    with get_conn() as conn:
+    with get_conn(autocommit=True) as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
             cur.execute(
                 """
-                SELECT a.*, c.name AS client_name, c.phone AS client_phone,
-                       d.name AS doctor_name, s.name AS service_name,
-                       s.price, s.duration_minutes
-                FROM appointments a
-                JOIN clients c ON a.client_id = c.id
-                JOIN doctors d ON a.doctor_id = d.id
-                JOIN services s ON a.service_id = s.id
+                SELECT a.* FROM v_appointments_full a
                 WHERE a.id = %s
                 """,
                 (appointment_id,),
@@ -732,27 +836,27 @@ def save_message(phone: str, role: str, message: str):
     """Сохранить сообщение в историю чата."""
     with get_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO chat_history (phone, role, message) VALUES (%s, %s, %s)",
-                (phone, role, message),
-            )
+            _execute_prepared(cur, "q_save_message", (phone, role, message))
 
 
 def get_chat_history(phone: str, limit: int = 20) -> list[dict]:
     """Получить последние N сообщений из истории чата."""
-    with get_conn() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+    with get_conn(autocommit=True) as conn:
+        with conn.cursor() as cur:
+            # Готовый упорядоченный массив одним значением — без построения dict на каждую строку
             cur.execute(
                 """
-                SELECT role, message FROM (
+                SELECT COALESCE(json_agg(json_build_object('role', role, 'message', message)
+                                         ORDER BY created_at ASC), '[]')
+                FROM (
                     SELECT role, message, created_at
                     FROM chat_history WHERE phone = %s
                     ORDER BY created_at DESC LIMIT %s
-                ) sub ORDER BY created_at ASC
+                ) sub
                 """,
                 (phone, limit),
             )
-            return cur.fetchall()
+            return cur.fetchone()[0]
 
 
 # ==================== Контекст клиента (оптимизация) ====================
@@ -764,206 +868,199 @@ def get_client_context(phone: str) -> dict:
     """
     with get_conn() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            # 1. Клиент
-            cur.execute("SELECT * FROM clients WHERE phone = %s", (phone,))
-            client = cur.fetchone()
+            return _load_client_context(cur, phone)
+
 
-            # 2. Администратор? (таблица admin_users + fallback на ADMIN_PHONE)
+def begin_turn(phone: str, user_message: str) -> dict:
+    """Начать ход диалога за одну транзакцию: создать клиента (если нет),
+    сохранить входящее сообщение и загрузить контекст.
+    Заменяет get_client + create_client + save_message + get_client_context.
+    """
+    with get_conn() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
             cur.execute(
-                "SELECT 1 FROM admin_users WHERE phone = %s AND is_active = TRUE",
-                (phone,),
-            )
-            admin = cur.fetchone() is not None
-            if not admin:
-                from config import ADMIN_PHONE
-                admin = (phone == ADMIN_PHONE)
-
-            # 3. История посещений (последние 5)
-            visit_history = []
-            if client:
-                cur.execute(
-                    """
-                    SELECT a.appointment_date, a.status,
-                           d.name AS doctor_name, s.name AS service_name
-                    FROM appointments a
-                    JOIN doctors d ON a.doctor_id = d.id
-                    JOIN services s ON a.service_id = s.id
-                    WHERE a.client_id = %s AND a.status IN ('completed', 'scheduled')
-                    ORDER BY a.appointment_date DESC LIMIT 5
-                    """,
-                    (client["id"],),
+                """
+                WITH new_client AS (
+                    INSERT INTO clients (phone) VALUES (%s)
+                    ON CONFLICT (phone) DO NOTHING
                 )
-                visit_history = cur.fetchall()
+                INSERT INTO chat_history (phone, role, message) VALUES (%s, 'user', %s)
+                """,
+                (phone, phone, user_message),
+            )
+            return _load_client_context(cur, phone)
 
-            # 4. Предстоящие записи
-            upcoming = []
-            if client:
+
+def end_turn(phone: str, answer: str, window_start_id: int = None):
+    """Закрыть ход диалога: сохранить ответ ассистента и, если окно истории
+    было усечено, новую точку отсечения — в одной транзакции.
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            _execute_prepared(cur, "q_save_message", (phone, "assistant", answer))
+            if window_start_id:
                 cur.execute(
-                    """
-                    SELECT a.id, a.appointment_date, a.appointment_time, a.status,
-                           d.name AS doctor_name, s.name AS service_name
-                    FROM appointments a
-                    JOIN doctors d ON a.doctor_id = d.id
-                    JOIN services s ON a.service_id = s.id
-                    WHERE a.client_id = %s AND a.status = 'scheduled'
-                          AND (a.appointment_date > CURRENT_DATE
-                               OR (a.appointment_date = CURRENT_DATE AND a.appointment_time > CURRENT_TIME))
-                    ORDER BY a.appointment_date, a.appointment_time
-                    """,
-                    (client["id"],),
+                    "UPDATE clients SET chat_window_start_id = %s WHERE phone = %s",
+                    (window_start_id, phone),
                 )
-                upcoming = cur.fetchall()
 
-            # 5. История чата
-            history_limit = 20 if admin else 10
-            cur.execute(
-                """
-                SELECT role, message FROM (
-                    SELECT role, message, created_at
-                    FROM chat_history WHERE phone = %s
-                    ORDER BY created_at DESC LIMIT %s
-                ) sub ORDER BY created_at ASC
-                """,
-                (phone, history_limit),
-            )
-            chat_history = cur.fetchall()
 
-            return {
-                "client": client,
-                "is_admin": admin,
-                "visit_history": visit_history,
-                "upcoming": upcoming,
-                "chat_history": chat_history,
-            }
+def _load_client_context(cur, phone: str) -> dict:
+    """Загрузить контекст клиента на уже открытом курсоре (RealDictCursor) — один запрос.
+    Записи и история приходят JSON-массивами (даты/время — строками ISO).
+    """
+    from config import ADMIN_PHONE
+    _execute_prepared(cur, "q_client_context", (phone, phone == ADMIN_PHONE))
+    row = cur.fetchone()
+    return {
+        "client": row["client"],
+        "is_admin": row["is_admin"],
+        "visit_history": row["visit_history"],
+        "upcoming": row["upcoming"],
+        "chat_history": row["chat_history"],
+    }
 
 
 # ==================== Администраторы ====================
 
-def is_admin(phone: str) -> bool:
-    """Проверить, является ли номер администратором."""
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "SELECT 1 FROM admin_users WHERE phone = %s AND is_active = TRUE",
-                (phone,),
-            )
-            return cur.fetchone() is not None
+# Админы и блок-лист меняются редко, а проверяются на каждое сообщение:
+# держим весь набор номеров в памяти и проверяем членство без запроса к БД
+ADMIN_CACHE_TTL = 300
+BLOCKED_CACHE_TTL = 60
 
 
-def get_all_admin_phones() -> list[str]:
-    """Получить список телефонов всех активных админов."""
-    with get_conn() as conn:
+def _load_admin_phones() -> frozenset[str]:
+    with get_conn(autocommit=True) as conn:
         with conn.cursor() as cur:
             cur.execute("SELECT phone FROM admin_users WHERE is_active = TRUE")
-            phones = [row[0] for row in cur.fetchall()]
+            return frozenset(row[0] for row in cur.fetchall())
+
+
+def is_admin(phone: str) -> bool:
+    """Проверить, является ли номер администратором."""
+    return phone in _cached_lookup(("admins",), _load_admin_phones, ADMIN_CACHE_TTL)
+
+
+def get_all_admin_phones() -> frozenset[str]:
+    """Получить набор телефонов всех активных админов (из кэша, без копирования)."""
+    phones = _cached_lookup(("admins",), _load_admin_phones, ADMIN_CACHE_TTL)
     # Fallback на ADMIN_PHONE если таблица пустая
     if not phones:
         from config import ADMIN_PHONE
-        phones = [ADMIN_PHONE]
+        phones = frozenset((ADMIN_PHONE,))
     return phones
 
 
 # ==================== Напоминания ====================
 
-def get_appointments_for_reminder(hours_before: int) -> list[dict]:
-    """Получить записи, для которых нужно отправить напоминание."""
-    from config import TIMEZONE
-
-    # Определяем какое поле использовать для отслеживания
+def _reminder_field(hours_before: int) -> str:
+    """Колонка-флаг напоминания за hours_before часов."""
     if hours_before >= 24:
-        reminder_field = "reminder_24h_sent"
-    elif hours_before >= 2:
-        reminder_field = "reminder_2h_sent"
-    else:
-        reminder_field = "reminder_1h_sent"
+        return "reminder_24h_sent"
+    if hours_before >= 2:
+        return "reminder_2h_sent"
+    return "reminder_1h_sent"
+
+
+def claim_due_reminders(hours_list: list[int]) -> list[dict]:
+    """Забрать записи, которым пора отправить напоминание (за любое из hours_list часов),
+    и сразу пометить их отправленными — все окна одним UPDATE ... RETURNING за тик.
+    Строки захватываются через SKIP LOCKED, поэтому два воркера не получат одну запись.
+    В каждой строке hours_before — за сколько часов напоминание. Если отправка не удалась —
+    вернуть флаг через release_reminders, следующий тик попробует снова.
+    Окна (±10 минут) не пересекаются, так что запись попадает максимум в одно.
+    """
+    from config import TIMEZONE
 
     with get_conn() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            # Проверяем и добавляем колонку reminder_1h_sent если нужно (для обратной совместимости)
-            if hours_before == 1:
-                cur.execute("""
-                    SELECT column_name FROM information_schema.columns
-                    WHERE table_name = 'appointments' AND column_name = 'reminder_1h_sent'
-                """)
-                if not cur.fetchone():
-                    # Колонка не существует - добавляем её
-                    cur.execute("ALTER TABLE appointments ADD COLUMN IF NOT EXISTS reminder_1h_sent BOOLEAN DEFAULT FALSE")
-                    conn.commit()
-                    logger.info("Added reminder_1h_sent column to appointments table")
-
+        with conn.cursor() as cur:
             # ВАЖНО: Используем часовой пояс для правильного сравнения времени
             cur.execute(
-                f"""
-                SELECT a.id, a.appointment_date, a.appointment_time,
+                """
+                WITH due AS (
+                    SELECT a.id, h.hours
+                    FROM unnest(%(hours)s::int[]) AS h(hours)
+                    JOIN appointments a
+                      ON a.status = 'scheduled'
+                     AND (a.appointment_date + a.appointment_time)
+                         BETWEEN (NOW() AT TIME ZONE %(tz)s) + make_interval(hours => h.hours) - interval '10 minutes'
+                         AND (NOW() AT TIME ZONE %(tz)s) + make_interval(hours => h.hours) + interval '10 minutes'
+                     AND CASE WHEN h.hours >= 24 THEN a.reminder_24h_sent
+                              WHEN h.hours >= 2 THEN a.reminder_2h_sent
+                              ELSE a.reminder_1h_sent END = FALSE
+                    FOR UPDATE OF a SKIP LOCKED
+                ), claimed AS (
+                    UPDATE appointments a SET
+                        reminder_24h_sent = a.reminder_24h_sent OR due.hours >= 24,
+                        reminder_2h_sent = a.reminder_2h_sent OR (due.hours >= 2 AND due.hours < 24),
+                        reminder_1h_sent = a.reminder_1h_sent OR due.hours < 2
+                    FROM due
+                    WHERE a.id = due.id
+                    RETURNING a.id, due.hours AS hours_before, a.client_id, a.doctor_id, a.service_id,
+                              a.appointment_date, a.appointment_time
+                )
+                SELECT cl.id, cl.hours_before, cl.appointment_date, cl.appointment_time,
                        c.name AS client_name, c.phone AS client_phone,
                        d.name AS doctor_name, s.name AS service_name
-                FROM appointments a
-                JOIN clients c ON a.client_id = c.id
-                JOIN doctors d ON a.doctor_id = d.id
-                JOIN services s ON a.service_id = s.id
-                WHERE a.status = 'scheduled'
-                      AND a.{reminder_field} = FALSE
-                      AND (a.appointment_date + a.appointment_time)
-                          BETWEEN (NOW() AT TIME ZONE %s) + make_interval(hours => %s) - interval '10 minutes'
-                          AND (NOW() AT TIME ZONE %s) + make_interval(hours => %s) + interval '10 minutes'
+                FROM claimed cl
+                JOIN clients c ON cl.client_id = c.id
+                JOIN doctors d ON cl.doctor_id = d.id
+                JOIN services s ON cl.service_id = s.id
                 """,
-                (TIMEZONE, hours_before, TIMEZONE, hours_before),
+                {"hours": list(hours_list), "tz": TIMEZONE},
             )
-            result = cur.fetchall()
-            if result:
-                logger.info(f"Found {len(result)} appointments for {hours_before}h reminder")
-            return result
+            result = _fetch_dicts(cur)
+    if result:
+        logger.info(f"Claimed {len(result)} appointments for reminders")
+    return result
 
 
-def mark_reminder_sent(appointment_id: int, hours_before: int):
-    """Пометить, что напоминание отправлено."""
-    if hours_before >= 24:
-        field = "reminder_24h_sent"
-    elif hours_before >= 2:
-        field = "reminder_2h_sent"
-    else:
-        field = "reminder_1h_sent"
-
+def release_reminders(failed: list[tuple[int, int]]):
+    """Снять отметки напоминаний, которые не удалось отправить: [(appointment_id, hours_before)].
+    Одна транзакция — по UPDATE на колонку-флаг.
+    """
+    if not failed:
+        return
+    by_field = {}
+    for appointment_id, hours_before in failed:
+        by_field.setdefault(_reminder_field(hours_before), []).append(appointment_id)
     with get_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                f"UPDATE appointments SET {field} = TRUE WHERE id = %s",
-                (appointment_id,),
-            )
+            for field, ids in by_field.items():
+                cur.execute(f"UPDATE appointments SET {field} = FALSE WHERE id = ANY(%s)", (ids,))
 
 
-def get_appointments_to_complete() -> list[dict]:
-    """Получить записи, которые прошли более 1 часа назад и нужно отметить как завершённые."""
+def complete_past_appointments() -> list[dict]:
+    """Завершить записи, прошедшие более 1 часа назад, и вернуть их (для Calendar/Sheets).
+    Отбор и UPDATE — один запрос; SKIP LOCKED не даёт двум воркерам завершить одну запись.
+    """
     from config import TIMEZONE
 
     with get_conn() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        with conn.cursor() as cur:
             cur.execute(
                 """
-                SELECT a.id, a.google_calendar_event_id,
+                WITH done AS (
+                    UPDATE appointments a SET status = 'completed', updated_at = NOW()
+                    WHERE a.id IN (
+                        SELECT id FROM appointments
+                        WHERE status = 'scheduled'
+                              AND (appointment_date + appointment_time) < (NOW() AT TIME ZONE %s) - interval '1 hour'
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING a.id, a.google_calendar_event_id, a.client_id, a.doctor_id, a.service_id
+                )
+                SELECT dn.id, dn.google_calendar_event_id,
                        c.name AS client_name, c.phone AS client_phone,
-                       d.name AS doctor_name, s.name AS service_name
-                FROM appointments a
-                JOIN clients c ON a.client_id = c.id
-                JOIN doctors d ON a.doctor_id = d.id
-                JOIN services s ON a.service_id = s.id
-                WHERE a.status = 'scheduled'
-                      AND (a.appointment_date + a.appointment_time) < (NOW() AT TIME ZONE %s) - interval '1 hour'
+                       d.name AS doctor_name, s.name AS service_name, s.price
+                FROM done dn
+                JOIN clients c ON dn.client_id = c.id
+                JOIN doctors d ON dn.doctor_id = d.id
+                JOIN services s ON dn.service_id = s.id
                 """,
                 (TIMEZONE,),
             )
-            return cur.fetchall()
-
-
-def mark_appointment_completed(appointment_id: int) -> bool:
-    """Отметить запись как завершённую."""
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "UPDATE appointments SET status = 'completed', updated_at = NOW() WHERE id = %s AND status = 'scheduled'",
-                (appointment_id,),
-            )
-            return cur.rowcount > 0
+            return _fetch_dicts(cur)
 
 
 # ==================== Follow-up ====================
@@ -984,24 +1081,21 @@ def schedule_follow_up(appointment_id: int, follow_up_date: date, notes: str = N
 
 def get_upcoming_follow_ups(days_ahead: int = 3) -> list[dict]:
     """Получить follow-up записи, до которых осталось N дней."""
-    with get_conn() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+    with get_conn(autocommit=True) as conn:
+        with conn.cursor() as cur:
             cur.execute(
                 """
                 SELECT a.id, a.follow_up_date, a.follow_up_notes,
-                       c.phone AS client_phone, c.name AS client_name,
-                       d.name AS doctor_name, s.name AS service_name
-                FROM appointments a
-                JOIN clients c ON a.client_id = c.id
-                JOIN doctors d ON a.doctor_id = d.id
-                JOIN services s ON a.service_id = s.id
+                       a.client_phone, a.client_name,
+                       a.doctor_name, a.service_name
+                FROM v_appointments_full a
                 WHERE a.follow_up_date IS NOT NULL
                       AND a.follow_up_date BETWEEN CURRENT_DATE AND CURRENT_DATE + %s
                       AND a.status = 'completed'
                 """,
                 (days_ahead,),
             )
-            return cur.fetchall()
+            return _fetch_dicts(cur)
 
 
 # ==================== No-show ====================
@@ -1020,17 +1114,14 @@ def mark_no_show(appointment_id: int) -> bool:
 def get_today_unconfirmed() -> list[dict]:
     """Получить сегодняшние завершённые по времени записи, ещё не отмеченные (для подтверждения админом)."""
     from config import TIMEZONE
-    with get_conn() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+    with get_conn(autocommit=True) as conn:
+        with conn.cursor() as cur:
             cur.execute(
                 """
                 SELECT a.id, a.appointment_date, a.appointment_time,
-                       c.name AS client_name, c.phone AS client_phone,
-                       d.name AS doctor_name, s.name AS service_name
-                FROM appointments a
-                JOIN clients c ON a.client_id = c.id
-                JOIN doctors d ON a.doctor_id = d.id
-                JOIN services s ON a.service_id = s.id
+                       a.client_name, a.client_phone,
+                       a.doctor_name, a.service_name
+                FROM v_appointments_full a
                 WHERE a.appointment_date = CURRENT_DATE
                       AND a.status = 'scheduled'
                       AND (a.appointment_date + a.appointment_time) < (NOW() AT TIME ZONE %s) - interval '30 minutes'
@@ -1038,7 +1129,7 @@ def get_today_unconfirmed() -> list[dict]:
                 """,
                 (TIMEZONE,),
             )
-            return cur.fetchall()
+            return _fetch_dicts(cur)
 
 
 # ==================== Блок-лист ====================
@@ -1051,7 +1142,9 @@ def block_client(phone: str, reason: str = None) -> bool:
                 "UPDATE clients SET is_blocked = TRUE, block_reason = %s WHERE phone = %s",
                 (reason, phone),
             )
-            return cur.rowcount > 0
+            updated = cur.rowcount > 0
+    _reference_cache.pop(("blocked",), None)
+    return updated
 
 
 def unblock_client(phone: str) -> bool:
@@ -1062,19 +1155,21 @@ def unblock_client(phone: str) -> bool:
                 "UPDATE clients SET is_blocked = FALSE, block_reason = NULL WHERE phone = %s",
                 (phone,),
             )
-            return cur.rowcount > 0
+            updated = cur.rowcount > 0
+    _reference_cache.pop(("blocked",), None)
+    return updated
 
 
 def is_client_blocked(phone: str) -> bool:
-    """Проверить, заблокирован ли клиент."""
-    with get_conn() as conn:
+    """Проверить, заблокирован ли клиент (по кэшу блок-листа)."""
+    return phone in _cached_lookup(("blocked",), _load_blocked_phones, BLOCKED_CACHE_TTL)
+
+
+def _load_blocked_phones() -> frozenset[str]:
+    with get_conn(autocommit=True) as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                "SELECT is_blocked FROM clients WHERE phone = %s",
-                (phone,),
-            )
-            row = cur.fetchone()
-            return row[0] if row else False
+            cur.execute("SELECT phone FROM clients WHERE is_blocked = TRUE")
+            return frozenset(row[0] for row in cur.fetchall())
 
 
 # ==================== Платежи ====================
@@ -1098,25 +1193,31 @@ def record_payment(appointment_id: int, actual_price: int, payment_status: str =
 def sync_services_from_list(services_data: list[dict]) -> int:
     """Синхронизировать услуги из списка (Google Sheets). Возвращает кол-во обновлённых."""
     updated = 0
-    sheet_ids = []
+    sheet_ids = [s["id"] for s in services_data]
     with get_conn() as conn:
         with conn.cursor() as cur:
-            for s in services_data:
-                sheet_ids.append(s["id"])
-                cur.execute(
+            # Все услуги — одним многострочным upsert вместо INSERT на каждую
+            if services_data:
+                rows = psycopg2.extras.execute_values(
+                    cur,
                     """
                     INSERT INTO services (id, name, price, duration_minutes, description, is_active)
-                    VALUES (%s, %s, %s, %s, %s, TRUE)
+                    VALUES %s
                     ON CONFLICT (id) DO UPDATE SET
                         name = EXCLUDED.name,
                         price = EXCLUDED.price,
                         duration_minutes = EXCLUDED.duration_minutes,
                         description = EXCLUDED.description,
                         is_active = TRUE
+                    RETURNING id
                     """,
-                    (s["id"], s["name"], s["price"], s["duration_minutes"], s.get("description", "")),
+                    [(s["id"], s["name"], s["price"], s["duration_minutes"], s.get("description", ""))
+                     for s in services_data],
+                    template="(%s, %s, %s, %s, %s, TRUE)",
+                    page_size=200,
+                    fetch=True,
                 )
-                updated += cur.rowcount
+                updated = len(rows)
 
             # Деактивировать услуги которых нет в Google Sheets
             if sheet_ids:
@@ -1127,23 +1228,84 @@ def sync_services_from_list(services_data: list[dict]) -> int:
                 deactivated = cur.rowcount
                 if deactivated:
                     logger.info(f"Deactivated {deactivated} services not in Sheets")
+    invalidate_reference_cache()
     return updated
 
 
-# ==================== Очистка ====================
 
-def cleanup_old_chat_history(days: int = 90) -> int:
-    """Удалить сообщения из chat_history старше N дней. Возвращает количество удалённых."""
+_DAY_NAMES_RU = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
+
+
+def _parse_clinic_hours(hours_str: str) -> tuple[time, time, bool]:
+    """«09:00–18:00» → (start, end, is_open); «Выходной» → закрыто; мусор → 09:00–18:00."""
+    if hours_str == "Выходной":
+        return time(9, 0), time(18, 0), False
+    try:
+        start_str, end_str = hours_str.replace("–", "-").split("-")
+        start_h, start_m = map(int, start_str.strip().split(":"))
+        end_h, end_m = map(int, end_str.strip().split(":"))
+        return time(start_h, start_m), time(end_h, end_m), True
+    except (ValueError, AttributeError):
+        return time(9, 0), time(18, 0), True
+
+
+def sync_clinic_hours(clinic_hours: dict) -> int:
+    """Записать часы работы клиники ({"Понедельник": "09:00–18:00", ...}) в clinic_hours.
+    Разбор строк делается здесь один раз, а не в каждом get_free_slots.
+    """
+    rows = [
+        (day_idx, *_parse_clinic_hours(clinic_hours.get(day_name, "Выходной")))
+        for day_idx, day_name in enumerate(_DAY_NAMES_RU)
+    ]
     with get_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                "DELETE FROM chat_history WHERE created_at < NOW() - make_interval(days => %s)",
-                (days,),
+            psycopg2.extras.execute_values(
+                cur,
+                """
+                INSERT INTO clinic_hours (day_of_week, start_time, end_time, is_open)
+                VALUES %s
+                ON CONFLICT (day_of_week) DO UPDATE SET
+                    start_time = EXCLUDED.start_time,
+                    end_time = EXCLUDED.end_time,
+                    is_open = EXCLUDED.is_open
+                """,
+                rows,
             )
-            deleted = cur.rowcount
-            if deleted:
-                logger.info(f"Cleaned up {deleted} old chat messages (>{days} days)")
-            return deleted
+    return len(rows)
+
+
+# ==================== Очистка ====================
+
+CLEANUP_BATCH_SIZE = 5000
+
+
+def cleanup_old_chat_history(days: int = 90) -> int:
+    """Удалить сообщения из chat_history старше N дней. Возвращает количество удалённых.
+    Удаляем пачками по CLEANUP_BATCH_SIZE, каждая — своя короткая транзакция: без долгих
+    блокировок, и autovacuum успевает подбирать мёртвые строки между пачками.
+    Старые сообщения — в начале по id, поэтому обход PK по возрастанию находит их сразу.
+    """
+    deleted = 0
+    while True:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    DELETE FROM chat_history WHERE id IN (
+                        SELECT id FROM chat_history
+                        WHERE created_at < NOW() - make_interval(days => %s)
+                        ORDER BY id LIMIT %s
+                    )
+                    """,
+                    (days, CLEANUP_BATCH_SIZE),
+                )
+                batch = cur.rowcount
+        deleted += batch
+        if batch < CLEANUP_BATCH_SIZE:
+            break
+    if deleted:
+        logger.info(f"Cleaned up {deleted} old chat messages (>{days} days)")
+    return deleted
 
 
 # ==================== Отчеты ====================
@@ -1156,65 +1318,42 @@ def get_month_stats(year: int, month: int) -> dict:
     else:
         end = date(year, month + 1, 1)
 
-    with get_conn() as conn:
+    # Все метрики — одним запросом: один проход по записям месяца (FILTER-агрегаты)
+    # плюс подзапросы для новых клиентов и топа врачей
+    with get_conn(autocommit=True) as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            # Общее количество
-            cur.execute(
-                "SELECT COUNT(*) AS total FROM appointments WHERE appointment_date BETWEEN %s AND %s",
-                (start, end - timedelta(days=1)),
-            )
-            total = cur.fetchone()["total"]
-
-            # По статусам
             cur.execute(
                 """
-                SELECT status, COUNT(*) AS cnt FROM appointments
-                WHERE appointment_date BETWEEN %s AND %s
-                GROUP BY status
-                """,
-                (start, end - timedelta(days=1)),
-            )
-            by_status = {r["status"]: r["cnt"] for r in cur.fetchall()}
-
-            # Новые клиенты
-            cur.execute(
-                "SELECT COUNT(*) AS cnt FROM clients WHERE created_at BETWEEN %s AND %s",
-                (start, end),
-            )
-            new_clients = cur.fetchone()["cnt"]
-
-            # Общий доход (только завершенные + запланированные)
-            cur.execute(
-                """
-                SELECT COALESCE(SUM(s.price), 0) AS revenue
+                SELECT COUNT(*) AS total,
+                       COUNT(*) FILTER (WHERE a.status = 'scheduled') AS scheduled,
+                       COUNT(*) FILTER (WHERE a.status = 'completed') AS completed,
+                       COUNT(*) FILTER (WHERE a.status = 'cancelled') AS cancelled,
+                       COUNT(*) FILTER (WHERE a.status = 'no_show') AS no_show,
+                       -- Общий доход (только завершенные + запланированные)
+                       COALESCE(SUM(s.price) FILTER (WHERE a.status IN ('completed', 'scheduled')), 0) AS revenue,
+                       (SELECT COUNT(*) FROM clients WHERE created_at BETWEEN %(start)s AND %(end)s) AS new_clients,
+                       (SELECT COALESCE(json_agg(json_build_object('name', t.name, 'cnt', t.cnt)), '[]'::json)
+                        FROM (
+                            SELECT d.name, COUNT(*) AS cnt
+                            FROM appointments a2 JOIN doctors d ON a2.doctor_id = d.id
+                            WHERE a2.appointment_date BETWEEN %(start)s AND %(last)s AND a2.status != 'cancelled'
+                            GROUP BY d.name ORDER BY cnt DESC LIMIT 5
+                        ) t) AS top_doctors
                 FROM appointments a
-                JOIN services s ON a.service_id = s.id
-                WHERE a.appointment_date BETWEEN %s AND %s
-                      AND a.status IN ('completed', 'scheduled')
+                LEFT JOIN services s ON a.service_id = s.id
+                WHERE a.appointment_date BETWEEN %(start)s AND %(last)s
                 """,
-                (start, end - timedelta(days=1)),
+                {"start": start, "end": end, "last": end - timedelta(days=1)},
             )
-            revenue = cur.fetchone()["revenue"]
+            row = cur.fetchone()
 
-            # Топ врачей
-            cur.execute(
-                """
-                SELECT d.name, COUNT(*) AS cnt
-                FROM appointments a JOIN doctors d ON a.doctor_id = d.id
-                WHERE a.appointment_date BETWEEN %s AND %s AND a.status != 'cancelled'
-                GROUP BY d.name ORDER BY cnt DESC LIMIT 5
-                """,
-                (start, end - timedelta(days=1)),
-            )
-            top_doctors = cur.fetchall()
-
-            return {
-                "total": total,
-                "scheduled": by_status.get("scheduled", 0),
-                "completed": by_status.get("completed", 0),
-                "cancelled": by_status.get("cancelled", 0),
-                "no_show": by_status.get("no_show", 0),
-                "new_clients": new_clients,
-                "revenue": int(revenue),
-                "top_doctors": top_doctors,
-            }
+    return {
+        "total": row["total"],
+        "scheduled": row["scheduled"],
+        "completed": row["completed"],
+        "cancelled": row["cancelled"],
+        "no_show": row["no_show"],
+        "new_clients": row["new_clients"],
+        "revenue": int(row["revenue"]),
+        "top_doctors": row["top_doctors"],
+    }
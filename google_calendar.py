@@ -8,6 +8,8 @@ Google Calendar — создание/обновление/удаление со
 """
 
 import logging
+import random
+import threading
 import time as _time
 from datetime import datetime, timedelta
 from google.oauth2.service_account import Credentials
@@ -19,21 +21,64 @@ from config import GOOGLE_CALENDAR_ID, GOOGLE_CREDENTIALS_PATH, TIMEZONE
 logger = logging.getLogger(__name__)
 
 
-def _retry_google_api(func, *args, max_retries=3, **kwargs):
-    """Обёртка retry для Google API с exponential backoff (429/5xx)."""
+class _TokenBucket:
+    """Ограничитель частоты запросов: rate токенов в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = _time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n: int = 1):
+        """Взять n токенов; если их нет — подождать, пока накопятся.
+        n больше capacity уводит счёт в минус — следующие вызовы дождутся своей доли.
+        """
+        need = min(n, self.capacity)
+        while True:
+            with self._lock:
+                now = _time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= need:
+                    self._tokens -= n
+                    return
+                wait = (need - self._tokens) / self.rate
+            _time.sleep(wait)
+
+
+# Квота Calendar API — 600 запросов/мин на пользователя: держимся чуть ниже (9/с)
+_bucket = _TokenBucket(rate=9, capacity=20)
+
+
+def _is_rate_limited(e: HttpError) -> bool:
+    """429 или 403 с причиной rateLimitExceeded/userRateLimitExceeded."""
+    if e.resp.status == 429:
+        return True
+    return e.resp.status == 403 and b"ratelimitexceeded" in (e.content or b"").lower()
+
+
+def _retry_google_api(func, *args, max_retries=3, tokens=1, **kwargs):
+    """Обёртка retry для Google API: exponential backoff с full jitter (429/403 rate limit/5xx).
+    tokens — сколько запросов квоты стоит вызов (для batch — число подзапросов).
+    """
     for attempt in range(max_retries):
+        _bucket.acquire(tokens)
         try:
             return func(*args, **kwargs)
         except HttpError as e:
-            if e.resp.status in (429, 500, 503) and attempt < max_retries - 1:
-                wait = 2 ** attempt
-                logger.warning(f"Google API {e.resp.status}, retry in {wait}s (attempt {attempt + 1})")
+            if (_is_rate_limited(e) or e.resp.status in (500, 503)) and attempt < max_retries - 1:
+                # Случайная пауза — воркеры не повторяют запрос синхронно
+                wait = random.uniform(0, 2 ** attempt)
+                logger.warning(f"Google API {e.resp.status}, retry in {wait:.1f}s (attempt {attempt + 1})")
                 _time.sleep(wait)
                 continue
             raise
     return None
 
-_service = None
+_creds = None
+_local = threading.local()  # клиент API на поток
 
 # Цвета Google Calendar
 COLOR_ACTIVE = "10"      # Зелёный (Basil)
@@ -41,25 +86,61 @@ COLOR_CANCELLED = "11"   # Красный (Tomato)
 COLOR_RESCHEDULED = "5"  # Жёлтый (Banana)
 COLOR_COMPLETED = "8"    # Серый (Graphite)
 
+BATCH_SIZE = 50  # Лимит запросов в одном batch для Calendar API
+
 
 def _get_service():
-    """Инициализировать Google Calendar API (singleton)."""
-    global _service
-    if _service:
-        return _service
+    """Google Calendar API для текущего потока.
+    httplib2.Http внутри клиента не потокобезопасен, поэтому у каждого потока свой
+    клиент (и своё keep-alive соединение); учётные данные общие на процесс.
+    """
+    global _creds
+    service = getattr(_local, "service", None)
+    if service:
+        return service
     try:
-        creds = Credentials.from_service_account_file(
-            GOOGLE_CREDENTIALS_PATH,
-            scopes=["https://www.googleapis.com/auth/calendar"],
-        )
-        _service = build("calendar", "v3", credentials=creds, cache_discovery=False)
-        logger.info("Google Calendar API initialized")
-        return _service
+        if _creds is None:
+            _creds = Credentials.from_service_account_file(
+                GOOGLE_CREDENTIALS_PATH,
+                scopes=["https://www.googleapis.com/auth/calendar"],
+            )
+            logger.info("Google Calendar API initialized")
+        _local.service = build("calendar", "v3", credentials=_creds, cache_discovery=False)
+        return _local.service
     except Exception as e:
         logger.warning(f"Google Calendar not available: {e}")
         return None
 
 
+# Поля записи, из которых собираются summary/description события
+_EVENT_TEXT_FIELDS = ("client_name", "client_phone", "service_name", "price")
+
+
+def _event_text(appointment: dict) -> dict:
+    """summary/description события в том виде, в каком их создаёт create_event."""
+    return {
+        "summary": f"{appointment.get('service_name', 'Прием')} — {appointment.get('client_name', 'Клиент')}",
+        "description": (
+            f"Пациент: {appointment.get('client_name', '—')}\n"
+            f"Телефон: {appointment.get('client_phone', '—')}\n"
+            f"Услуга: {appointment.get('service_name', '—')}\n"
+            f"Цена: {appointment.get('price', '—')} ₸\n"
+            f"Статус: Активна"
+        ),
+    }
+
+
+def _current_event(service, event_id: str, appointment: dict = None) -> dict:
+    """Текущие summary/description события. Если есть строка записи — собираем локально
+    (как при создании) и обходимся без events().get; иначе читаем событие из Calendar.
+    """
+    if appointment is not None and all(k in appointment for k in _EVENT_TEXT_FIELDS):
+        return _event_text(appointment)
+    return _retry_google_api(
+        service.events().get(calendarId=GOOGLE_CALENDAR_ID, eventId=event_id).execute
+    )
+
+
 def create_event(appointment: dict) -> str | None:
     """Создать событие в Google Calendar. Возвращает event_id."""
     service = _get_service()
@@ -74,14 +155,7 @@ def create_event(appointment: dict) -> str | None:
         end_dt = start_dt + timedelta(minutes=appointment.get("duration_minutes", 30))
 
         event = {
-            "summary": f"{appointment.get('service_name', 'Прием')} — {appointment.get('client_name', 'Клиент')}",
-            "description": (
-                f"Пациент: {appointment.get('client_name', '—')}\n"
-                f"Телефон: {appointment.get('client_phone', '—')}\n"
-                f"Услуга: {appointment.get('service_name', '—')}\n"
-                f"Цена: {appointment.get('price', '—')} ₸\n"
-                f"Статус: Активна"
-            ),
+            **_event_text(appointment),
             "start": {"dateTime": start_dt.isoformat(), "timeZone": TIMEZONE},
             "end":   {"dateTime": end_dt.isoformat(),   "timeZone": TIMEZONE},
             "location": "Стоматологическая клиника",
@@ -108,8 +182,10 @@ def create_event(appointment: dict) -> str | None:
         return None
 
 
-def update_event(event_id: str, new_date, new_time, duration: int = 30) -> bool:
-    """Обновить дату/время события и пометить как перенесённое (жёлтый)."""
+def update_event(event_id: str, new_date, new_time, duration: int = 30, appointment: dict = None) -> bool:
+    """Обновить дату/время события и пометить как перенесённое (жёлтый).
+    appointment — строка записи (client_*, service_name, price): тогда без лишнего GET.
+    """
     service = _get_service()
     if not service or not event_id:
         return False
@@ -118,10 +194,8 @@ def update_event(event_id: str, new_date, new_time, duration: int = 30) -> bool:
         start_dt = datetime.combine(new_date, new_time)
         end_dt = start_dt + timedelta(minutes=duration)
 
-        # Получаем текущее событие чтобы обновить описание
-        current = _retry_google_api(
-            service.events().get(calendarId=GOOGLE_CALENDAR_ID, eventId=event_id).execute
-        )
+        # Текущее описание — чтобы обновить статус
+        current = _current_event(service, event_id, appointment)
 
         # Обновляем описание со статусом
         description = current.get("description", "")
@@ -152,33 +226,20 @@ def update_event(event_id: str, new_date, new_time, duration: int = 30) -> bool:
 
 
 def cancel_event(event_id: str, appointment: dict = None, reason: str = None) -> bool:
-    """Отметить событие как отменённое (красный цвет, зачёркнутый текст)."""
+    """Отметить событие как отменённое (красный цвет, зачёркнутый текст).
+    appointment — строка записи: тогда только patch, без предварительного GET.
+    """
     service = _get_service()
     if not service or not event_id:
         return False
 
     try:
-        current = _retry_google_api(
-            service.events().get(calendarId=GOOGLE_CALENDAR_ID, eventId=event_id).execute
-        )
-
-        summary = current.get("summary", "")
-        if not summary.startswith("[ОТМЕНЕНО]"):
-            summary = f"[ОТМЕНЕНО] {summary}"
-
-        description = current.get("description", "")
-        if "Статус:" in description:
-            description = description.rsplit("Статус:", 1)[0] + "Статус: ОТМЕНЕНА"
-        else:
-            description += "\nСтатус: ОТМЕНЕНА"
-
-        if reason:
-            description += f"\nПричина отмены: {reason}"
+        current = _current_event(service, event_id, appointment)
 
         _retry_google_api(
             service.events().patch(
                 calendarId=GOOGLE_CALENDAR_ID, eventId=event_id,
-                body={"summary": summary, "description": description, "colorId": COLOR_CANCELLED},
+                body=_cancelled_body(current, reason),
             ).execute
         )
 
@@ -190,31 +251,153 @@ def cancel_event(event_id: str, appointment: dict = None, reason: str = None) ->
         return False
 
 
-def complete_event(event_id: str) -> bool:
-    """Отметить событие как завершённое (серый цвет)."""
+def cancel_events(event_ids: list[str], reason: str = None, appointments: list[dict] = None) -> int:
+    """Отметить несколько событий как отменённые batch-запросами.
+    appointments — строки записей (с google_calendar_event_id): для них тело patch
+    собирается локально, batch-get нужен только для остальных.
+    Возвращает количество успешно отменённых.
+    """
+    service = _get_service()
+    event_ids = [e for e in event_ids if e]
+    if not service or not event_ids:
+        return 0
+
+    bodies = {}
+    for appt in appointments or ():
+        event_id = appt.get("google_calendar_event_id")
+        if event_id in event_ids and all(k in appt for k in _EVENT_TEXT_FIELDS):
+            bodies[event_id] = _cancelled_body(_event_text(appt), reason)
+
+    def _on_get(request_id, response, exception):
+        if exception:
+            logger.error(f"Calendar batch get error ({request_id}): {exception}")
+        else:
+            bodies[request_id] = _cancelled_body(response, reason)
+
+    _run_batches(
+        service,
+        [e for e in event_ids if e not in bodies],
+        lambda event_id: service.events().get(calendarId=GOOGLE_CALENDAR_ID, eventId=event_id),
+        _on_get,
+        "get",
+    )
+
+    cancelled = _patch_events(service, bodies, "cancel")
+    logger.info(f"Calendar events cancelled (batch): {cancelled}/{len(event_ids)}")
+    return cancelled
+
+
+def complete_events(appointments: list[dict]) -> int:
+    """Отметить события завершённых записей серыми — batch patch по BATCH_SIZE за HTTP-запрос.
+    Тела собираются из строк записей; строки без нужных полей идут через complete_event.
+    Возвращает количество успешно обновлённых.
+    """
+    service = _get_service()
+    appointments = [a for a in appointments if a.get("google_calendar_event_id")]
+    if not service or not appointments:
+        return 0
+
+    bodies = {}
+    completed = 0
+    for appt in appointments:
+        if all(k in appt for k in _EVENT_TEXT_FIELDS):
+            bodies[appt["google_calendar_event_id"]] = _completed_body(_event_text(appt))
+        elif complete_event(appt["google_calendar_event_id"], appt):
+            completed += 1
+
+    completed += _patch_events(service, bodies, "complete")
+    logger.info(f"Calendar events completed (batch): {completed}/{len(appointments)}")
+    return completed
+
+
+def _patch_events(service, bodies: dict, action: str) -> int:
+    """Batch patch {event_id: body} по BATCH_SIZE за HTTP-запрос. Возвращает число успешных."""
+    patched = []
+
+    def _on_patch(request_id, response, exception):
+        if exception:
+            logger.error(f"Calendar batch {action} error ({request_id}): {exception}")
+        else:
+            patched.append(request_id)
+
+    _run_batches(
+        service,
+        list(bodies),
+        lambda event_id: service.events().patch(
+            calendarId=GOOGLE_CALENDAR_ID, eventId=event_id, body=bodies[event_id],
+        ),
+        _on_patch,
+        action,
+    )
+    return len(patched)
+
+
+def _run_batches(service, request_ids: list[str], make_request, callback, action: str, max_rounds: int = 3):
+    """Выполнить запросы batch-ами по BATCH_SIZE; каждый batch стоит len(chunk) токенов квоты.
+    Подзапросы, отклонённые лимитом (429/403 rateLimitExceeded), собираются и повторяются
+    следующим раундом после паузы; остальные результаты уходят в callback.
+    """
+    pending = request_ids
+    for attempt in range(max_rounds):
+        limited = []
+
+        def _on_response(request_id, response, exception):
+            if isinstance(exception, HttpError) and _is_rate_limited(exception) and attempt < max_rounds - 1:
+                limited.append(request_id)
+            else:
+                callback(request_id, response, exception)
+
+        for i in range(0, len(pending), BATCH_SIZE):
+            chunk = pending[i:i + BATCH_SIZE]
+            try:
+                batch = service.new_batch_http_request(callback=_on_response)
+                for request_id in chunk:
+                    batch.add(make_request(request_id), request_id=request_id)
+                _retry_google_api(batch.execute, tokens=len(chunk))
+            except Exception as e:
+                logger.error(f"Calendar batch {action} error: {e}")
+
+        if not limited:
+            return
+        wait = random.uniform(0, 2 ** attempt)
+        logger.warning(f"Calendar batch {action}: {len(limited)} rate limited, retry in {wait:.1f}s")
+        _time.sleep(wait)
+        pending = limited
+
+
+def _cancelled_body(current: dict, reason: str = None) -> dict:
+    """Тело patch для отменённого события: [ОТМЕНЕНО], статус, причина, красный цвет."""
+    summary = current.get("summary", "")
+    if not summary.startswith("[ОТМЕНЕНО]"):
+        summary = f"[ОТМЕНЕНО] {summary}"
+
+    description = current.get("description", "")
+    if "Статус:" in description:
+        description = description.rsplit("Статус:", 1)[0] + "Статус: ОТМЕНЕНА"
+    else:
+        description += "\nСтатус: ОТМЕНЕНА"
+
+    if reason:
+        description += f"\nПричина отмены: {reason}"
+
+    return {"summary": summary, "description": description, "colorId": COLOR_CANCELLED}
+
+
+def complete_event(event_id: str, appointment: dict = None) -> bool:
+    """Отметить событие как завершённое (серый цвет).
+    appointment — строка записи: тогда только patch, без предварительного GET.
+    """
     service = _get_service()
     if not service or not event_id:
         return False
 
     try:
-        current = _retry_google_api(
-            service.events().get(calendarId=GOOGLE_CALENDAR_ID, eventId=event_id).execute
-        )
-
-        summary = current.get("summary", "")
-        if not summary.startswith("[ЗАВЕРШЕНО]"):
-            summary = f"[ЗАВЕРШЕНО] {summary}"
-
-        description = current.get("description", "")
-        if "Статус:" in description:
-            description = description.rsplit("Статус:", 1)[0] + "Статус: ЗАВЕРШЕНО"
-        else:
-            description += "\nСтатус: ЗАВЕРШЕНО"
+        current = _current_event(service, event_id, appointment)
 
         _retry_google_api(
             service.events().patch(
                 calendarId=GOOGLE_CALENDAR_ID, eventId=event_id,
-                body={"summary": summary, "description": description, "colorId": COLOR_COMPLETED},
+                body=_completed_body(current),
             ).execute
         )
 
@@ -226,6 +409,21 @@ def complete_event(event_id: str) -> bool:
         return False
 
 
+def _completed_body(current: dict) -> dict:
+    """Тело patch для завершённого события: [ЗАВЕРШЕНО], статус, серый цвет."""
+    summary = current.get("summary", "")
+    if not summary.startswith("[ЗАВЕРШЕНО]"):
+        summary = f"[ЗАВЕРШЕНО] {summary}"
+
+    description = current.get("description", "")
+    if "Статус:" in description:
+        description = description.rsplit("Статус:", 1)[0] + "Статус: ЗАВЕРШЕНО"
+    else:
+        description += "\nСтатус: ЗАВЕРШЕНО"
+
+    return {"summary": summary, "description": description, "colorId": COLOR_COMPLETED}
+
+
 def delete_event(event_id: str) -> bool:
     """Удалить событие из календаря (используй cancel_event вместо этого)."""
     service = _get_service()
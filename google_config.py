@@ -7,10 +7,15 @@ Google Sheets как источник настроек клиники.
 - Услуги и цены
 - Врачей
 
-Кэширование: 15 минут (900 секунд)
+Кэширование: 15 минут (900 секунд); неудачные загрузки (API недоступен,
+пустой лист) — 1 минута, чтобы fallback не стоил запроса к Google на каждый вызов.
+Истёкшее значение отдаётся сразу, а перечитывается в фоновом потоке
+(stale-while-revalidate) — запрос пользователя не ждёт Sheets API.
+Старше часа после истечения значение не отдаётся — читается заново синхронно.
 """
 
 import logging
+import threading
 import time
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
@@ -19,51 +24,113 @@ from config import GOOGLE_SHEETS_ID, GOOGLE_CREDENTIALS_PATH
 
 logger = logging.getLogger(__name__)
 
-# Кэширование
+# Кэширование: ключ → (значение, время истечения по monotonic). Одна запись на ключ
+# читается атомарно, поэтому потокам достаточно блокировки на запись/очистку.
 _cache = {}
-_cache_time = {}
+_cache_lock = threading.Lock()
 CACHE_TTL = 900  # 15 минут
+FALLBACK_CACHE_TTL = 60  # для fallback-значений (ошибка/пустой лист)
+STALE_TTL = 3600  # сколько ещё отдавать истёкшее значение, пока идёт фоновое обновление
 
-_service = None
+_creds = None
+_local = threading.local()  # клиент API на поток
+
+# Фоновое обновление: ключи, которые сейчас перечитываются, и флаг потока-обновлятеля
+_refreshing = set()
+_refresh_lock = threading.Lock()
+_refresh_local = threading.local()
 
 
 def _get_service():
-    """Инициализировать Google Sheets API (singleton)."""
-    global _service
-    if _service:
-        return _service
+    """Google Sheets API для текущего потока.
+    httplib2.Http внутри клиента не потокобезопасен, поэтому у каждого потока свой
+    клиент (и своё keep-alive соединение); учётные данные общие на процесс.
+    """
+    global _creds
+    service = getattr(_local, "service", None)
+    if service:
+        return service
     try:
-        creds = Credentials.from_service_account_file(
-            GOOGLE_CREDENTIALS_PATH,
-            scopes=["https://www.googleapis.com/auth/spreadsheets.readonly"],
-        )
-        _service = build("sheets", "v4", credentials=creds, cache_discovery=False)
-        logger.info("Google Sheets Config API initialized")
-        return _service
+        if _creds is None:
+            _creds = Credentials.from_service_account_file(
+                GOOGLE_CREDENTIALS_PATH,
+                scopes=["https://www.googleapis.com/auth/spreadsheets.readonly"],
+            )
+            logger.info("Google Sheets Config API initialized")
+        _local.service = build("sheets", "v4", credentials=_creds, cache_discovery=False)
+        return _local.service
     except Exception as e:
         logger.warning(f"Google Sheets Config not available: {e}")
         return None
 
 
 def _get_cached(key: str):
-    """Получить значение из кэша если не истекло."""
-    if key in _cache and key in _cache_time:
-        if time.time() - _cache_time[key] < CACHE_TTL:
-            return _cache[key]
-    return None
-
-
-def _set_cache(key: str, value):
-    """Сохранить значение в кэш."""
-    _cache[key] = value
-    _cache_time[key] = time.time()
+    """Получить значение из кэша. Истёкшее тоже возвращается, но ключ уходит
+    на фоновое перечитывание. None — значения нет (или это сам поток обновления).
+    """
+    if getattr(_refresh_local, "active", False):
+        return None
+    entry = _cache.get(key)
+    if entry is None:
+        return None
+    value, expires = entry
+    now = time.monotonic()
+    if now >= expires:
+        if now >= expires + STALE_TTL:
+            return None  # слишком старое — перечитать синхронно
+        _refresh_in_background(key)
+    return value
+
+
+def _refresh_in_background(key: str):
+    """Перечитать ключ из Sheets в daemon-потоке (не больше одного потока на ключ)."""
+    loader = _LOADERS.get(key)
+    if loader is None:
+        return
+    with _refresh_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def run():
+        _refresh_local.active = True
+        try:
+            loader()  # сам кладёт результат (или fallback) в кэш
+        except Exception as e:
+            logger.warning(f"Background refresh of {key} failed: {e}")
+        finally:
+            with _refresh_lock:
+                _refreshing.discard(key)
+
+    threading.Thread(target=run, name=f"sheets-refresh-{key}", daemon=True).start()
+
+
+def _set_cache(key: str, value, ttl: float = CACHE_TTL):
+    """Сохранить значение в кэш на ttl секунд."""
+    with _cache_lock:
+        _cache[key] = (value, time.monotonic() + ttl)
+
+
+def _cache_fallback(key: str, value):
+    """Запомнить fallback-значение ненадолго и вернуть его.
+    Для услуг/врачей fallback — None (читать из БД); в кэше хранится как [].
+    Если не удалось фоновое обновление, прежнее значение из Sheets остаётся
+    и отдаётся дальше, следующая попытка — через FALLBACK_CACHE_TTL.
+    """
+    if getattr(_refresh_local, "active", False):
+        with _cache_lock:
+            entry = _cache.get(key)
+            if entry and entry[0]:
+                _cache[key] = (entry[0], time.monotonic() + FALLBACK_CACHE_TTL)
+                return entry[0]
+    _set_cache(key, value if value is not None else [], ttl=FALLBACK_CACHE_TTL)
+    return value
 
 
 def clear_cache():
     """Очистить весь кэш (для принудительного обновления)."""
-    global _cache, _cache_time
-    _cache = {}
-    _cache_time = {}
+    with _cache_lock:
+        _cache.clear()
     logger.info("Config cache cleared")
 
 
@@ -87,7 +154,7 @@ def get_clinic_settings() -> dict:
 
     service = _get_service()
     if not service:
-        return _get_default_clinic_settings()
+        return _cache_fallback("clinic_settings", _get_default_clinic_settings())
 
     try:
         result = service.spreadsheets().values().get(
@@ -124,7 +191,7 @@ def get_clinic_settings() -> dict:
 
     except Exception as e:
         logger.warning(f"Error loading clinic settings: {e}")
-        return _get_default_clinic_settings()
+        return _cache_fallback("clinic_settings", _get_default_clinic_settings())
 
 
 def _get_default_clinic_settings() -> dict:
@@ -157,7 +224,7 @@ def get_clinic_hours() -> dict:
 
     service = _get_service()
     if not service:
-        return _get_default_clinic_hours()
+        return _cache_fallback("clinic_hours", _get_default_clinic_hours())
 
     try:
         result = service.spreadsheets().values().get(
@@ -180,15 +247,29 @@ def get_clinic_hours() -> dict:
                 hours[day] = time_str
 
         if not hours:
-            return _get_default_clinic_hours()
+            return _cache_fallback("clinic_hours", _get_default_clinic_hours())
 
+        previous = _cache.get("clinic_hours")
         _set_cache("clinic_hours", hours)
         logger.info("Clinic hours loaded from Sheets")
+        if previous is None or previous[0] != hours:
+            _sync_clinic_hours_to_db(hours)
         return hours
 
     except Exception as e:
         logger.warning(f"Error loading clinic hours: {e}")
-        return _get_default_clinic_hours()
+        return _cache_fallback("clinic_hours", _get_default_clinic_hours())
+
+
+def _sync_clinic_hours_to_db(hours: dict):
+    """Изменившиеся часы сразу пишем в таблицу clinic_hours: get_free_slots считает
+    слоты по ней, а промпт — по кэшу этого модуля, они не должны расходиться.
+    """
+    try:
+        import db
+        db.sync_clinic_hours(hours)
+    except Exception as e:
+        logger.warning(f"Clinic hours DB sync failed: {e}")
 
 
 def _get_default_clinic_hours() -> dict:
@@ -198,9 +279,33 @@ def _get_default_clinic_hours() -> dict:
 
 
 # ============================================================
-# УСЛУГИ
+# УСЛУГИ И ВРАЧИ
 # ============================================================
 
+# Значения колонки "Активна"/"Активен", считающиеся «да»
+_ACTIVE_TOKENS_SERVICE = frozenset({"да", "yes", "true", "1", "активна"})
+_ACTIVE_TOKENS_DOCTOR = frozenset({"да", "yes", "true", "1", "активен"})
+
+def _is_active(cell, tokens: frozenset) -> bool:
+    """Значение колонки активности — «да»? Чистое значение ("да") проверяется
+    без strip/lower, нормализация — только для остальных. Флажок/число (листы
+    читаются UNFORMATTED_VALUE) — по истинности.
+    """
+    if not isinstance(cell, str):
+        return bool(cell)
+    return cell in tokens or cell.strip().lower() in tokens
+
+
+# Очистка цены за один проход: "15 000 ₸", "15,000" → "15000"
+_PRICE_TRANS = str.maketrans("", "", " ,₸")
+
+
+def _parse_price(cell) -> int:
+    """Цена из ячейки: число как есть; текст (цену ввели строкой) — после очистки."""
+    if isinstance(cell, (int, float)):
+        return int(cell)
+    return int(cell.translate(_PRICE_TRANS))
+
 def get_services() -> list[dict]:
     """
     Получить услуги из листа "Услуги".
@@ -209,70 +314,12 @@ def get_services() -> list[dict]:
     | 1 | Консультация | 5000 | 30 | ... | Да |
     """
     cached = _get_cached("services")
-    if cached:
-        return cached
-
-    service = _get_service()
-    if not service:
-        return None  # Fallback на БД
-
-    try:
-        result = service.spreadsheets().values().get(
-            spreadsheetId=GOOGLE_SHEETS_ID,
-            range="Услуги!A:H",
-        ).execute()
-
-        values = result.get("values", [])
-        services = []
-
-        if not values:
-            return None
-
-        header = values[0]
-        header_len = len(header)
-
-        for row in values[1:]:  # Пропускаем заголовок
-            # Если данные сдвинуты (больше столбцов чем в заголовке) — выравниваем
-            offset = len(row) - header_len if len(row) > header_len else 0
-            r = row[offset:]
-
-            if len(r) >= 5:
-                # Проверяем активность
-                is_active = True
-                if len(r) >= 6:
-                    active_str = r[5].strip().lower()
-                    is_active = active_str in ["да", "yes", "true", "1", "активна"]
-
-                if not is_active:
-                    continue
-
-                try:
-                    services.append({
-                        "id": int(r[0]) if r[0] else len(services) + 1,
-                        "name": r[1].strip(),
-                        "price": int(r[2].replace(" ", "").replace(",", "").replace("₸", "")),
-                        "duration_minutes": int(r[3]) if r[3] else 30,
-                        "description": r[4].strip() if len(r) > 4 else "",
-                    })
-                except (ValueError, IndexError) as e:
-                    logger.warning(f"Skipping invalid service row: {row}, error: {e}")
-                    continue
-
-        if services:
-            _set_cache("services", services)
-            logger.info(f"Services loaded from Sheets: {len(services)} items")
-            return services
-        else:
-            return None  # Fallback на БД
-
-    except Exception as e:
-        logger.warning(f"Error loading services: {e}")
-        return None  # Fallback на БД
+    if cached is not None:
+        return cached or None  # [] — недавний fallback на БД
 
+    _load_reference_sheets()
+    return _peek_cached("services") or None  # None — fallback на БД
 
-# ============================================================
-# ВРАЧИ
-# ============================================================
 
 def get_doctors() -> list[dict]:
     """
@@ -282,52 +329,132 @@ def get_doctors() -> list[dict]:
     | 1 | Иванов А.П. | Терапевт | 12 | ... | Да |
     """
     cached = _get_cached("doctors")
-    if cached:
-        return cached
+    if cached is not None:
+        return cached or None  # [] — недавний fallback на БД
 
+    _load_reference_sheets()
+    return _peek_cached("doctors") or None  # None — fallback на БД
+
+
+def _peek_cached(key: str):
+    """Значение из кэша как есть (без проверки срока и фонового обновления)."""
+    entry = _cache.get(key)
+    return entry[0] if entry else None
+
+
+def _load_reference_sheets():
+    """Загрузить листы "Услуги" и "Врачи" одним batchGet и положить оба в кэш.
+    Кто бы ни промахнулся кэшем первым — второй лист приезжает тем же запросом.
+    Пустой лист или ошибка — короткий fallback (на БД) для соответствующего ключа.
+    """
     service = _get_service()
     if not service:
-        return None  # Fallback на БД
+        _cache_fallback("services", None)
+        _cache_fallback("doctors", None)
+        return
 
     try:
-        result = service.spreadsheets().values().get(
+        result = service.spreadsheets().values().batchGet(
             spreadsheetId=GOOGLE_SHEETS_ID,
-            range="Врачи!A:F",
+            ranges=["Услуги!A:H", "Врачи!A:F"],
+            majorDimension="ROWS",
+            valueRenderOption="UNFORMATTED_VALUE",  # числа приходят числами, без "5 000 ₸"
         ).execute()
-
-        values = result.get("values", [])
-        doctors = []
-
-        for row in values[1:]:  # Пропускаем заголовок
-            if len(row) >= 3:
-                # Проверяем активность
-                is_active = True
-                if len(row) >= 6:
-                    active_str = row[5].strip().lower()
-                    is_active = active_str in ["да", "yes", "true", "1", "активен"]
-
-                if not is_active:
-                    continue
-
-                try:
-                    doctors.append({
-                        "id": int(row[0]) if row[0] else len(doctors) + 1,
-                        "name": row[1].strip(),
-                        "specialization": row[2].strip(),
-                        "experience_years": int(row[3]) if len(row) > 3 and row[3] else 0,
-                        "bio": row[4].strip() if len(row) > 4 else "",
-                    })
-                except (ValueError, IndexError) as e:
-                    logger.warning(f"Skipping invalid doctor row: {row}, error: {e}")
-                    continue
-
-        if doctors:
-            _set_cache("doctors", doctors)
-            logger.info(f"Doctors loaded from Sheets: {len(doctors)} items")
-            return doctors
-        else:
-            return None  # Fallback на БД
-
+        value_ranges = result.get("valueRanges", [])
+        services_values = value_ranges[0].get("values", []) if len(value_ranges) > 0 else []
+        doctors_values = value_ranges[1].get("values", []) if len(value_ranges) > 1 else []
     except Exception as e:
-        logger.warning(f"Error loading doctors: {e}")
-        return None  # Fallback на БД
+        logger.warning(f"Error loading services/doctors: {e}")
+        _cache_fallback("services", None)
+        _cache_fallback("doctors", None)
+        return
+
+    services = _parse_services(services_values)
+    if services:
+        _set_cache("services", services)
+        logger.info(f"Services loaded from Sheets: {len(services)} items")
+    else:
+        _cache_fallback("services", None)
+
+    doctors = _parse_doctors(doctors_values)
+    if doctors:
+        _set_cache("doctors", doctors)
+        logger.info(f"Doctors loaded from Sheets: {len(doctors)} items")
+    else:
+        _cache_fallback("doctors", None)
+
+
+def _parse_services(values: list) -> list[dict]:
+    """Строки листа "Услуги" → активные услуги."""
+    services = []
+    if not values:
+        return services
+
+    header = values[0]
+    header_len = len(header)
+
+    for row in values[1:]:  # Пропускаем заголовок
+        # Если данные сдвинуты (больше столбцов чем в заголовке) — выравниваем
+        offset = len(row) - header_len if len(row) > header_len else 0
+        r = row[offset:]
+
+        if len(r) >= 5:
+            # Проверяем активность
+            is_active = True
+            if len(r) >= 6:
+                is_active = _is_active(r[5], _ACTIVE_TOKENS_SERVICE)
+
+            if not is_active:
+                continue
+
+            try:
+                services.append({
+                    "id": int(r[0]) if r[0] else len(services) + 1,
+                    "name": str(r[1]).strip(),
+                    "price": _parse_price(r[2]),
+                    "duration_minutes": int(r[3]) if r[3] else 30,
+                    "description": str(r[4]).strip() if len(r) > 4 else "",
+                })
+            except (ValueError, IndexError) as e:
+                logger.warning(f"Skipping invalid service row: {row}, error: {e}")
+                continue
+
+    return services
+
+
+def _parse_doctors(values: list) -> list[dict]:
+    """Строки листа "Врачи" → активные врачи."""
+    doctors = []
+
+    for row in values[1:]:  # Пропускаем заголовок
+        if len(row) >= 3:
+            # Проверяем активность
+            is_active = True
+            if len(row) >= 6:
+                is_active = _is_active(row[5], _ACTIVE_TOKENS_DOCTOR)
+
+            if not is_active:
+                continue
+
+            try:
+                doctors.append({
+                    "id": int(row[0]) if row[0] else len(doctors) + 1,
+                    "name": str(row[1]).strip(),
+                    "specialization": str(row[2]).strip(),
+                    "experience_years": int(row[3]) if len(row) > 3 and row[3] else 0,
+                    "bio": str(row[4]).strip() if len(row) > 4 else "",
+                })
+            except (ValueError, IndexError) as e:
+                logger.warning(f"Skipping invalid doctor row: {row}, error: {e}")
+                continue
+
+    return doctors
+
+
+# Загрузчики для фонового обновления (ключ кэша → функция)
+_LOADERS = {
+    "clinic_settings": get_clinic_settings,
+    "clinic_hours": get_clinic_hours,
+    "services": _load_reference_sheets,
+    "doctors": _load_reference_sheets,
+}
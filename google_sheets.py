@@ -8,6 +8,11 @@ Google Sheets — экспорт отчетов с цветовой кодиро
 """
 
 import logging
+import queue
+import random
+import socket
+import ssl
+import threading
 import time as _time
 from datetime import datetime, date, time
 from google.oauth2.service_account import Credentials
@@ -19,21 +24,44 @@ from config import GOOGLE_SHEETS_ID, GOOGLE_CREDENTIALS_PATH
 logger = logging.getLogger(__name__)
 
 
-def _retry_google_api(func, *args, max_retries=3, **kwargs):
-    """Обёртка retry для Google Sheets API (429/5xx)."""
+_RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+_TRANSPORT_ERRORS = (ConnectionError, TimeoutError, socket.timeout, ssl.SSLError)
+_MAX_BACKOFF = 32
+
+
+def _backoff(attempt: int) -> float:
+    """Пауза перед повтором: 2^n секунд + случайная доля секунды, не больше _MAX_BACKOFF."""
+    return min(2 ** attempt + random.random(), _MAX_BACKOFF)
+
+
+def _retry_google_api(func, *args, max_retries=3, idempotent=True, **kwargs):
+    """Обёртка retry для Google Sheets API (408/429/5xx и сетевые ошибки).
+    idempotent=False — для append: при обрыве соединения строка могла уже добавиться,
+    поэтому повторяем только явные отказы сервера.
+    """
     for attempt in range(max_retries):
         try:
             return func(*args, **kwargs)
         except HttpError as e:
-            if e.resp.status in (429, 500, 503) and attempt < max_retries - 1:
-                wait = 2 ** attempt
-                logger.warning(f"Google Sheets API {e.resp.status}, retry in {wait}s (attempt {attempt + 1})")
+            if e.resp.status in _RETRY_STATUSES and attempt < max_retries - 1:
+                wait = _backoff(attempt)
+                logger.warning(f"Google Sheets API {e.resp.status}, retry in {wait:.1f}s (attempt {attempt + 1})")
+                _time.sleep(wait)
+                continue
+            raise
+        except _TRANSPORT_ERRORS as e:
+            if idempotent and attempt < max_retries - 1:
+                wait = _backoff(attempt)
+                logger.warning(f"Google Sheets API {type(e).__name__}, retry in {wait:.1f}s (attempt {attempt + 1})")
                 _time.sleep(wait)
                 continue
             raise
     return None
 
-_service = None
+_creds = None
+_local = threading.local()  # клиент API на поток
+_sheet_id_cache: int | None = None  # sheetId листа не меняется за время жизни процесса
+_row_index: dict[str, int] = {}  # ID записи → индекс строки (с 0) на листе 'Dental clinic'
 
 # Цвета (RGB 0-1)
 COLOR_GREEN = {"red": 0.7, "green": 0.9, "blue": 0.7}   # Светло-зелёный
@@ -41,36 +69,58 @@ COLOR_RED = {"red": 0.95, "green": 0.7, "blue": 0.7}    # Светло-крас
 COLOR_YELLOW = {"red": 1.0, "green": 0.95, "blue": 0.7}  # Светло-жёлтый
 COLOR_GRAY = {"red": 0.8, "green": 0.8, "blue": 0.8}    # Серый
 
+_STATUS_COLORS = {
+    "scheduled": COLOR_GREEN,
+    "cancelled": COLOR_RED,
+    "rescheduled": COLOR_YELLOW,
+    "completed": COLOR_GRAY,
+}
+
 
 def _get_service():
-    """Инициализировать Google Sheets API (singleton)."""
-    global _service
-    if _service:
-        return _service
+    """Google Sheets API для текущего потока.
+    httplib2.Http внутри клиента не потокобезопасен, поэтому у каждого потока свой
+    клиент (и своё keep-alive соединение); учётные данные общие на процесс.
+    """
+    global _creds
+    service = getattr(_local, "service", None)
+    if service:
+        return service
     try:
-        creds = Credentials.from_service_account_file(
-            GOOGLE_CREDENTIALS_PATH,
-            scopes=["https://www.googleapis.com/auth/spreadsheets"],
-        )
-        _service = build("sheets", "v4", credentials=creds, cache_discovery=False)
-        logger.info("Google Sheets API initialized")
-        return _service
+        if _creds is None:
+            _creds = Credentials.from_service_account_file(
+                GOOGLE_CREDENTIALS_PATH,
+                scopes=["https://www.googleapis.com/auth/spreadsheets"],
+            )
+            logger.info("Google Sheets API initialized")
+        _local.service = build("sheets", "v4", credentials=_creds, cache_discovery=False)
+        return _local.service
     except Exception as e:
         logger.warning(f"Google Sheets not available: {e}")
         return None
 
 
 def _get_sheet_id() -> int | None:
-    """Получить ID листа 'Dental clinic'."""
+    """Получить ID листа 'Dental clinic' (запрашивается один раз за процесс)."""
+    global _sheet_id_cache
+    if _sheet_id_cache is not None:
+        return _sheet_id_cache
     service = _get_service()
     if not service:
         return None
     try:
-        spreadsheet = service.spreadsheets().get(spreadsheetId=GOOGLE_SHEETS_ID).execute()
+        spreadsheet = _retry_google_api(
+            service.spreadsheets().get(
+                spreadsheetId=GOOGLE_SHEETS_ID,
+                fields="sheets.properties(sheetId,title)",
+            ).execute
+        )
+        _sheet_id_cache = 0  # Первый лист по умолчанию
         for sheet in spreadsheet.get("sheets", []):
             if sheet["properties"]["title"] == "Dental clinic":
-                return sheet["properties"]["sheetId"]
-        return 0  # Первый лист по умолчанию
+                _sheet_id_cache = sheet["properties"]["sheetId"]
+                break
+        return _sheet_id_cache
     except Exception as e:
         logger.error(f"Error getting sheet ID: {e}")
         return 0
@@ -105,14 +155,14 @@ def add_appointment(appointment: dict) -> bool:
                 range="Dental clinic!A:J",
                 valueInputOption="USER_ENTERED",
                 body={"values": row},
-            ).execute
+            ).execute,
+            idempotent=False,
         )
 
         # Получаем номер добавленной строки
-        updated_range = result.get("updates", {}).get("updatedRange", "")
-        if updated_range:
-            # Пример: "Dental clinic!A5:J5" -> row 5
-            row_num = int(updated_range.split("!")[1].split(":")[0][1:]) - 1
+        row_num = _appended_start_row(result)
+        if row_num is not None:
+            _row_index[str(appt_id)] = row_num
             _color_row(row_num, COLOR_GREEN)
 
         logger.info(f"Appointment added to Sheets: {appointment.get('client_name')}")
@@ -123,6 +173,17 @@ def add_appointment(appointment: dict) -> bool:
         return False
 
 
+def _appended_start_row(result: dict) -> int | None:
+    """Индекс (с 0) первой строки, добавленной values().append.
+    Пример updatedRange: "'Dental clinic'!A5:J5" -> 4.
+    """
+    updated_range = (result or {}).get("updates", {}).get("updatedRange", "")
+    if not updated_range:
+        return None
+    start = updated_range.split("!")[1].split(":")[0]
+    return int(start.lstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ")) - 1
+
+
 def _color_row(row_index: int, color: dict) -> bool:
     """Покрасить строку в указанный цвет."""
     service = _get_service()
@@ -130,32 +191,14 @@ def _color_row(row_index: int, color: dict) -> bool:
         return False
 
     try:
-        sheet_id = _get_sheet_id()
+        request = {"requests": [_color_request(_get_sheet_id(), row_index, color)]}
 
-        request = {
-            "requests": [{
-                "repeatCell": {
-                    "range": {
-                        "sheetId": sheet_id,
-                        "startRowIndex": row_index,
-                        "endRowIndex": row_index + 1,
-                        "startColumnIndex": 0,
-                        "endColumnIndex": 10,
-                    },
-                    "cell": {
-                        "userEnteredFormat": {
-                            "backgroundColor": color
-                        }
-                    },
-                    "fields": "userEnteredFormat.backgroundColor"
-                }
-            }]
-        }
-
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=GOOGLE_SHEETS_ID,
-            body=request
-        ).execute()
+        _retry_google_api(
+            service.spreadsheets().batchUpdate(
+                spreadsheetId=GOOGLE_SHEETS_ID,
+                body=request
+            ).execute
+        )
 
         return True
 
@@ -164,6 +207,80 @@ def _color_row(row_index: int, color: dict) -> bool:
         return False
 
 
+def _color_request(sheet_id: int, row_index: int, color: dict) -> dict:
+    """repeatCell-запрос: фон строки row_index (колонки A–J)."""
+    return {
+        "repeatCell": {
+            "range": {
+                "sheetId": sheet_id,
+                "startRowIndex": row_index,
+                "endRowIndex": row_index + 1,
+                "startColumnIndex": 0,
+                "endColumnIndex": 10,
+            },
+            "cell": {
+                "userEnteredFormat": {
+                    "backgroundColor": color
+                }
+            },
+            "fields": "userEnteredFormat.backgroundColor"
+        }
+    }
+
+
+_SHEETS_EPOCH = date(1899, 12, 30)  # нулевой день серийных дат Google Sheets
+
+
+def _cell_value(value) -> dict:
+    """ExtendedValue для updateCells. Дата/время — серийным числом, как их хранит
+    Sheets после ввода с USER_ENTERED: формат ячейки сохраняется, колонка не
+    превращается в текст.
+    """
+    if isinstance(value, datetime):
+        value = value.date()
+    if isinstance(value, date):
+        return {"numberValue": (value - _SHEETS_EPOCH).days}
+    if isinstance(value, time):
+        return {"numberValue": (value.hour * 60 + value.minute) / 1440}
+    return {"stringValue": str(value)}
+
+
+def _find_row(service, appt_id) -> int | None:
+    """Индекс строки записи (с 0). Сначала по запомненному индексу — читается одна
+    ячейка ID для проверки (строки могли сдвинуть руками); иначе — скан колонки A.
+    """
+    key = str(appt_id)
+    row_index = _row_index.get(key)
+    if row_index is not None:
+        r = row_index + 1
+        result = _retry_google_api(
+            service.spreadsheets().values().get(
+                spreadsheetId=GOOGLE_SHEETS_ID,
+                range=f"Dental clinic!A{r}:A{r}",
+            ).execute
+        )
+        values = result.get("values", [])
+        if values and values[0] and values[0][0] == key:
+            return row_index
+
+    # Промах — читаем только колонку ID и запоминаем индексы всех строк
+    result = _retry_google_api(
+        service.spreadsheets().values().get(
+            spreadsheetId=GOOGLE_SHEETS_ID,
+            range="Dental clinic!A:A",
+        ).execute
+    )
+    # FORMATTED_VALUE (по умолчанию) — ячейки уже строки, str() не нужен
+    rows = {}
+    for i, row in enumerate(result.get("values", [])):
+        if row and row[0]:
+            rows.setdefault(row[0], i)
+    _row_index.update(rows)
+    if key not in rows:
+        _row_index.pop(key, None)
+    return rows.get(key)
+
+
 def update_appointment_status(appt_id: int, status: str, new_date=None, new_time=None, reason: str = None) -> bool:
     """Обновить статус записи в таблице и изменить цвет строки."""
     service = _get_service()
@@ -171,69 +288,19 @@ def update_appointment_status(appt_id: int, status: str, new_date=None, new_time
         return False
 
     try:
-        # Получаем все данные из таблицы
-        result = service.spreadsheets().values().get(
-            spreadsheetId=GOOGLE_SHEETS_ID,
-            range="Dental clinic!A:J",
-        ).execute()
-
-        values = result.get("values", [])
-
-        # Ищем строку с нужным ID
-        row_index = None
-        for i, row in enumerate(values):
-            if row and str(row[0]) == str(appt_id):
-                row_index = i
-                break
-
-        if row_index is None:
-            logger.warning(f"Appointment {appt_id} not found in Sheets")
+        requests = _status_requests(service, appt_id, status, new_date, new_time, reason)
+        if requests is None:
             return False
 
-        # Определяем новый статус и цвет
-        if status == "cancelled":
-            status_text = "ОТМЕНЕНА"
-            color = COLOR_RED
-        elif status == "rescheduled":
-            status_text = "ПЕРЕНЕСЕНА"
-            color = COLOR_YELLOW
-            # Обновляем дату и время если указаны
-            if new_date and new_time:
-                values[row_index][1] = str(new_date)
-                values[row_index][2] = str(new_time)[:5] if hasattr(new_time, 'isoformat') else str(new_time)[:5]
-        elif status == "completed":
-            status_text = "ЗАВЕРШЕНО"
-            color = COLOR_GRAY
-        else:
-            status_text = "Активна"
-            color = COLOR_GREEN
-
-        # Обновляем статус в строке
-        if len(values[row_index]) >= 9:
-            values[row_index][8] = status_text
-        else:
-            while len(values[row_index]) < 9:
-                values[row_index].append("")
-            values[row_index][8] = status_text
-
-        # Добавляем причину отмены в колонку K (индекс 10)
-        if status == "cancelled" and reason:
-            while len(values[row_index]) < 11:
-                values[row_index].append("")
-            values[row_index][10] = reason
-
-        # Обновляем данные в таблице
-        service.spreadsheets().values().update(
-            spreadsheetId=GOOGLE_SHEETS_ID,
-            range=f"Dental clinic!A{row_index + 1}:K{row_index + 1}",
-            valueInputOption="USER_ENTERED",
-            body={"values": [values[row_index]]}
-        ).execute()
-
-        # Красим строку
-        _color_row(row_index, color)
+        # Значения и цвет — одним batchUpdate (один HTTPS-запрос вместо двух)
+        _retry_google_api(
+            service.spreadsheets().batchUpdate(
+                spreadsheetId=GOOGLE_SHEETS_ID,
+                body={"requests": requests},
+            ).execute
+        )
 
-        logger.info(f"Appointment {appt_id} status updated to {status_text}")
+        logger.info(f"Appointment {appt_id} status updated to {status}")
         return True
 
     except Exception as e:
@@ -241,6 +308,144 @@ def update_appointment_status(appt_id: int, status: str, new_date=None, new_time
         return False
 
 
+def _status_requests(service, appt_id: int, status: str, new_date=None, new_time=None,
+                     reason: str = None) -> list[dict] | None:
+    """Запросы batchUpdate для смены статуса: изменённые ячейки + цвет строки.
+    None — записи нет в таблице.
+    """
+    row_index = _find_row(service, appt_id)
+    if row_index is None:
+        logger.warning(f"Appointment {appt_id} not found in Sheets")
+        return None
+
+    # Определяем новый статус и цвет; изменённые ячейки: колонка (индекс) → значение
+    cells = {}
+    if status == "cancelled":
+        status_text = "ОТМЕНЕНА"
+        color = COLOR_RED
+        # Причина отмены в колонку K (индекс 10)
+        if reason:
+            cells[10] = reason
+    elif status == "rescheduled":
+        status_text = "ПЕРЕНЕСЕНА"
+        color = COLOR_YELLOW
+        # Обновляем дату и время если указаны
+        if new_date and new_time:
+            cells[1] = new_date
+            cells[2] = new_time
+    elif status == "completed":
+        status_text = "ЗАВЕРШЕНО"
+        color = COLOR_GRAY
+    else:
+        status_text = "Активна"
+        color = COLOR_GREEN
+    cells[8] = status_text
+
+    sheet_id = _get_sheet_id()
+    requests = [
+        {
+            "updateCells": {
+                "start": {"sheetId": sheet_id, "rowIndex": row_index, "columnIndex": col},
+                "rows": [{"values": [{"userEnteredValue": _cell_value(value)}]}],
+                "fields": "userEnteredValue",
+            }
+        }
+        for col, value in sorted(cells.items())
+    ]
+    requests.append(_color_request(sheet_id, row_index, color))
+    return requests
+
+
+# ==================== Фоновая очередь записи ====================
+# Запись в Sheets (сотни мс на вызов, лимиты API) не должна держать ход диалога
+# или планировщик. Один поток-писатель разбирает очередь по порядку — добавление
+# строки всегда раньше смены её статуса; подряд идущие смены статуса за тик
+# уходят одним batchUpdate.
+
+SHEETS_FLUSH_INTERVAL = 1.0  # секунд: сколько копить изменения перед отправкой
+
+_write_queue = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def queue_add_appointment(appointment: dict):
+    """Добавить запись в таблицу в фоне (см. add_appointment)."""
+    _enqueue(("add", (appointment,), {}))
+
+
+def queue_status_update(appt_id: int, status: str, new_date=None, new_time=None, reason: str = None):
+    """Обновить статус записи в фоне (см. update_appointment_status)."""
+    _enqueue(("status", (appt_id, status, new_date, new_time, reason), {}))
+
+
+def _enqueue(item):
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = threading.Thread(target=_writer_loop, name="sheets-writer", daemon=True)
+                _writer.start()
+    _write_queue.put(item)
+
+
+def _writer_loop():
+    while True:
+        batch = [_write_queue.get()]
+        _time.sleep(SHEETS_FLUSH_INTERVAL)
+        while True:
+            try:
+                batch.append(_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _flush(batch)
+        except Exception as e:
+            logger.error(f"Sheets writer error: {e}")
+
+
+def _flush(batch: list):
+    """Выполнить накопленные операции по порядку; смены статуса подряд — одним batchUpdate."""
+    pending = []  # аргументы подряд идущих смен статуса
+    for kind, args, kwargs in batch:
+        if kind == "status":
+            pending.append(args)
+            continue
+        _flush_statuses(pending)
+        pending = []
+        add_appointment(*args, **kwargs)
+    _flush_statuses(pending)
+
+
+def _flush_statuses(pending: list):
+    if not pending:
+        return
+    if len(pending) == 1:
+        update_appointment_status(*pending[0])
+        return
+    service = _get_service()
+    if not service:
+        return
+    # Запросы собираем по одному: ошибка поиска строки теряет только её изменение
+    requests = []
+    for args in pending:
+        try:
+            requests.extend(_status_requests(service, *args) or [])
+        except Exception as e:
+            logger.error(f"Sheets status update skipped for appointment {args[0]}: {e}")
+    try:
+        if requests:
+            _retry_google_api(
+                service.spreadsheets().batchUpdate(
+                    spreadsheetId=GOOGLE_SHEETS_ID,
+                    body={"requests": requests},
+                ).execute
+            )
+        logger.info(f"Sheets status updates flushed: {len(pending)}")
+    except Exception as e:
+        logger.error(f"Sheets batch status update error: {e}")
+
+
 def export_appointments(appointments: list[dict], title: str) -> bool:
     """Экспортировать список записей в Google Sheets."""
     service = _get_service()
@@ -279,12 +484,16 @@ def export_appointments(appointments: list[dict], title: str) -> bool:
         rows.append([])
         rows.append(["", "Итого записей:", len(appointments)])
 
-        service.spreadsheets().values().append(
-            spreadsheetId=GOOGLE_SHEETS_ID,
-            range="Dental clinic",
-            valueInputOption="USER_ENTERED",
-            body={"values": rows},
-        ).execute()
+        result = _retry_google_api(
+            service.spreadsheets().values().append(
+                spreadsheetId=GOOGLE_SHEETS_ID,
+                range="Dental clinic",
+                valueInputOption="USER_ENTERED",
+                body={"values": rows},
+            ).execute,
+            idempotent=False,
+        )
+        _color_export_rows(service, result, appointments, header_rows=3)
 
         logger.info(f"Appointments exported to Sheets: {len(appointments)} rows")
         return True
@@ -294,6 +503,30 @@ def export_appointments(appointments: list[dict], title: str) -> bool:
         return False
 
 
+def _color_export_rows(service, append_result: dict, appointments: list[dict], header_rows: int):
+    """Покрасить строки экспорта по статусу — один batchUpdate на весь экспорт.
+    Ошибка окраски не отменяет сам экспорт.
+    """
+    start = _appended_start_row(append_result)
+    if start is None or not appointments:
+        return
+    try:
+        sheet_id = _get_sheet_id()
+        first = start + header_rows
+        requests = [
+            _color_request(sheet_id, first + i, _STATUS_COLORS.get(a.get("status", "scheduled"), COLOR_GREEN))
+            for i, a in enumerate(appointments)
+        ]
+        _retry_google_api(
+            service.spreadsheets().batchUpdate(
+                spreadsheetId=GOOGLE_SHEETS_ID,
+                body={"requests": requests},
+            ).execute
+        )
+    except Exception as e:
+        logger.warning(f"Sheets export coloring error: {e}")
+
+
 def export_month_stats(stats: dict, month_label: str) -> bool:
     """Экспортировать месячный отчет в Google Sheets."""
     service = _get_service()
@@ -319,12 +552,15 @@ def export_month_stats(stats: dict, month_label: str) -> bool:
         for doc in stats.get("top_doctors", []):
             rows.append([doc["name"], doc["cnt"]])
 
-        service.spreadsheets().values().append(
-            spreadsheetId=GOOGLE_SHEETS_ID,
-            range="Dental clinic",
-            valueInputOption="USER_ENTERED",
-            body={"values": rows},
-        ).execute()
+        _retry_google_api(
+            service.spreadsheets().values().append(
+                spreadsheetId=GOOGLE_SHEETS_ID,
+                range="Dental clinic",
+                valueInputOption="USER_ENTERED",
+                body={"values": rows},
+            ).execute,
+            idempotent=False,
+        )
 
         logger.info("Monthly stats exported to Sheets")
         return True
@@ -6,9 +6,14 @@ import os
 import time
 import threading
 import logging
+import weakref
+from collections import OrderedDict, deque
 from concurrent.futures import ThreadPoolExecutor
+import orjson
 from flask import Flask, request, jsonify
 
+import db
+from transcribe import transcribe_audio
 from whatsapp import get_provider
 from agents import process_message
 from scheduler import start_scheduler
@@ -17,7 +22,9 @@ from transports import get_transport
 
 # ======================== Дедупликация webhook-ов ========================
 
-_processed_messages = {}  # idMessage -> timestamp
+# idMessage -> timestamp (monotonic) в порядке вставки: самые старые всегда в начале
+_processed_messages = OrderedDict()
+_dedup_lock = threading.Lock()
 DEDUP_TTL = 300  # 5 минут
 _DEDUP_MAX_SIZE = 10000
 
@@ -26,21 +33,31 @@ def _is_duplicate(id_message: str) -> bool:
     """Проверить, обрабатывалось ли уже это сообщение (защита от повторных webhook)."""
     if not id_message:
         return False
-    now = time.time()
-    # Очистка старых записей (+ защита от переполнения)
-    if len(_processed_messages) > _DEDUP_MAX_SIZE or len(_processed_messages) % 100 == 0:
-        expired = [k for k, v in _processed_messages.items() if now - v > DEDUP_TTL]
-        for k in expired:
-            del _processed_messages[k]
-    if id_message in _processed_messages:
-        return True
-    _processed_messages[id_message] = now
+    now = time.monotonic()
+    with _dedup_lock:
+        # Повтор — сразу, одним поиском по словарю (ещё не вычищенная истёкшая запись не в счёт)
+        seen = _processed_messages.get(id_message)
+        if seen is not None and now - seen <= DEDUP_TTL:
+            return True
+        # Истёкшие записи снимаются с начала — без прохода по всему словарю
+        while _processed_messages and now - next(iter(_processed_messages.values())) > DEDUP_TTL:
+            _processed_messages.popitem(last=False)
+        _processed_messages[id_message] = now
+        # Защита от переполнения: вытесняем самые старые
+        while len(_processed_messages) > _DEDUP_MAX_SIZE:
+            _processed_messages.popitem(last=False)
     return False
 
 
+def _forget_message(id_message: str):
+    """Убрать сообщение из дедупликации (не было принято в обработку)."""
+    with _dedup_lock:
+        _processed_messages.pop(id_message, None)
+
+
 # ======================== Rate Limiting ========================
 
-_rate_limits = {}  # phone -> [timestamps]
+_rate_limits = {}  # phone -> deque(timestamps), старые слева
 RATE_LIMIT_MAX = 20  # сообщений за окно
 RATE_LIMIT_WINDOW = 60  # секунд
 _RATE_CLEANUP_COUNTER = 0
@@ -59,38 +76,34 @@ def _is_rate_limited(phone: str) -> bool:
         for p in stale:
             del _rate_limits[p]
 
-    if phone not in _rate_limits:
-        _rate_limits[phone] = []
-    _rate_limits[phone] = [t for t in _rate_limits[phone] if now - t < RATE_LIMIT_WINDOW]
-    if len(_rate_limits[phone]) >= RATE_LIMIT_MAX:
+    dq = _rate_limits.get(phone)
+    if dq is None:
+        dq = _rate_limits[phone] = deque()
+    while dq and now - dq[0] >= RATE_LIMIT_WINDOW:
+        dq.popleft()
+    if len(dq) >= RATE_LIMIT_MAX:
         return True
-    _rate_limits[phone].append(now)
+    dq.append(now)
     return False
 
 
 # ======================== Per-phone Lock ========================
 
-_phone_locks = {}
+# Слабые ссылки: lock исчезает сам, когда его больше не держит ни один обработчик
+_phone_locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
 _locks_lock = threading.Lock()
-_LOCK_CLEANUP_COUNTER = 0
 
 
 def _get_phone_lock(phone: str) -> threading.Lock:
-    """Получить lock для номера (сообщения от одного пациента обрабатываются последовательно)."""
-    global _LOCK_CLEANUP_COUNTER
-    with _locks_lock:
-        # Периодическая очистка неиспользуемых locks (каждые 500 вызовов)
-        _LOCK_CLEANUP_COUNTER += 1
-        if _LOCK_CLEANUP_COUNTER >= 500 and len(_phone_locks) > 100:
-            _LOCK_CLEANUP_COUNTER = 0
-            unlocked = [p for p, lk in _phone_locks.items() if not lk.locked()]
-            # Оставляем последние 50, чистим остальные
-            for p in unlocked[:-50]:
-                del _phone_locks[p]
-
-        if phone not in _phone_locks:
-            _phone_locks[phone] = threading.Lock()
-        return _phone_locks[phone]
+    """Получить lock для номера (сообщения от одного пациента обрабатываются последовательно).
+    Вызывающий держит ссылку на lock, пока обрабатывает сообщение.
+    """
+    with _locks_lock:  # get-or-create атомарно: двум потокам — один и тот же lock
+        lock = _phone_locks.get(phone)
+        if lock is None:
+            lock = threading.Lock()
+            _phone_locks[phone] = lock
+        return lock
 
 
 # ======================== Init ========================
@@ -122,6 +135,15 @@ wp = get_provider()
 # Пул потоков — ограничиваем до 10 (вместо безлимитных Thread)
 _executor = ThreadPoolExecutor(max_workers=10)
 
+# Очередь пула не ограничена: при потоке webhook-ов держим не больше MAX_PENDING
+# сообщений (в работе + ожидающих), остальные отклоняем — GREEN-API повторит позже
+MAX_PENDING = 500
+_pending = threading.BoundedSemaphore(MAX_PENDING)
+
+
+def _release_pending(_future):
+    _pending.release()
+
 
 # ======================== Webhooks ========================
 
@@ -137,7 +159,6 @@ def _process_in_background(phone: str, text: str, msg_type: str, download_url: s
             if not download_url:
                 wp.send_message(phone, "Не удалось получить голосовое сообщение. Пожалуйста, напишите текстом.")
                 return
-            from transcribe import transcribe_audio
             text = transcribe_audio(download_url)
             if not text:
                 wp.send_message(phone, "Не удалось распознать голосовое сообщение. Пожалуйста, напишите текстом.")
@@ -166,7 +187,13 @@ def _process_in_background(phone: str, text: str, msg_type: str, download_url: s
 def webhook_incoming():
     """Обработка входящих сообщений. Возвращает 200 мгновенно, обработка в фоне."""
     try:
-        data = request.get_json(silent=True) or {}
+        # orjson вместо stdlib json; битое/пустое тело — как get_json(silent=True)
+        try:
+            data = orjson.loads(request.get_data(cache=False)) or {}
+        except orjson.JSONDecodeError:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
 
         # Парсим сообщение в зависимости от провайдера
         parsed = wp.parse_webhook(data)
@@ -183,8 +210,7 @@ def webhook_incoming():
         msg_type = parsed.get("type", "text")
 
         # Блок-лист — заблокированные клиенты молча игнорируются
-        import db as _db
-        if _db.is_client_blocked(phone):
+        if db.is_client_blocked(phone):
             logger.info(f"Blocked client ignored: {phone}")
             return jsonify({"status": "blocked"}), 200
 
@@ -205,7 +231,12 @@ def webhook_incoming():
         download_url = parsed.get("download_url", "")
 
         # Запускаем обработку в пуле потоков — СРАЗУ возвращаем 200
-        _executor.submit(_process_in_background, phone, text, msg_type, download_url)
+        if not _pending.acquire(blocking=False):
+            logger.warning(f"Overloaded, message rejected: {phone}")
+            _forget_message(parsed.get("id_message", ""))  # повтор от GREEN-API не должен считаться дублем
+            return jsonify({"status": "overloaded"}), 503
+        future = _executor.submit(_process_in_background, phone, text, msg_type, download_url)
+        future.add_done_callback(_release_pending)
 
         return jsonify({"status": "processing"}), 200
 
@@ -5,91 +5,213 @@
   - Ежедневный отчет администратору в 09:00
 """
 
+import functools
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
+from urllib.parse import quote_plus
+from zoneinfo import ZoneInfo
 
-import pytz
 from apscheduler.schedulers.background import BackgroundScheduler
 
 import db
 import google_calendar
 import google_sheets
 from whatsapp import get_provider
-from config import ADMIN_PHONE, TIMEZONE, REMINDER_HOURS, DB_CONFIG
+from config import ADMIN_PHONE, TIMEZONE, REMINDER_HOURS, DB_CONFIG, SCHEDULER_DB_URL
 
 logger = logging.getLogger(__name__)
 
+_TZ = ZoneInfo(TIMEZONE)
 
-def send_reminders():
-    """Проверить и отправить напоминания клиентам."""
-    tz = pytz.timezone(TIMEZONE)
-    now = datetime.now(tz)
+
+def _single_instance(name: str):
+    """Задача выполняется только на одном инстансе одновременно (advisory-lock в Postgres):
+    если lock держит другой процесс — запуск пропускается.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            try:
+                with db.advisory_lock(f"job:{name}") as acquired:
+                    if not acquired:
+                        logger.info(f"Job {name} is running on another instance, skipped")
+                        return None
+                    try:
+                        return fn(*args, **kwargs)
+                    except Exception as e:
+                        logger.error(f"Job {name} failed: {e}", exc_info=True)
+                        return None
+            except Exception as e:
+                logger.error(f"Job {name}: advisory lock error: {e}")
+                return None
+        return wrapper
+    return decorator
+
+
+# Частые задачи (напоминания, автозавершение) ночью почти всегда пустые. Ночью
+# (по времени клиники, QUIET_NIGHT_START..QUIET_NIGHT_END) после
+# QUIET_AFTER_EMPTY_TICKS пустых тиков подряд задача выполняется только на одном
+# тике из нескольких — когда минута суток попадает в начало quiet_every-минутного
+# отрезка (по часам, поэтому одинаково на всех инстансах). Днём частота обычная;
+# первый непустой тик тоже возвращает обычную частоту.
+QUIET_AFTER_EMPTY_TICKS = 6
+QUIET_NIGHT_START = 21  # час
+QUIET_NIGHT_END = 7  # час
+REMINDERS_INTERVAL = 5  # минут
+COMPLETE_INTERVAL = 10  # минут
+
+_empty_ticks = {}
+
+
+def _quiet_when_idle(name: str, interval: int, quiet_every: int):
+    """Ночью прореживать тики задачи, пока она ничего не находит.
+    Задача возвращает число обработанных записей (None — неизвестно, счётчик не меняется).
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _empty_ticks.get(name, 0) >= QUIET_AFTER_EMPTY_TICKS:
+                now = datetime.now(_TZ)
+                night = now.hour >= QUIET_NIGHT_START or now.hour < QUIET_NIGHT_END
+                if night and (now.hour * 60 + now.minute) % quiet_every >= interval:
+                    return None
+            found = fn(*args, **kwargs)
+            if found is not None:
+                _empty_ticks[name] = 0 if found else _empty_ticks.get(name, 0) + 1
+            return found
+        return wrapper
+    return decorator
+
+
+# Рассылка напоминаний: параллельно, но не быстрее REMINDER_SEND_RATE сообщений/с
+# (антиспам-лимит GREEN-API/WhatsApp)
+REMINDER_SEND_WORKERS = 8
+REMINDER_SEND_RATE = 10
+
+_send_slot_lock = threading.Lock()
+_next_send_slot = 0.0
+
+
+def _wait_send_slot():
+    """Дождаться своей очереди на отправку: слоты идут с шагом 1/REMINDER_SEND_RATE."""
+    global _next_send_slot
+    with _send_slot_lock:
+        now = time.monotonic()
+        slot = max(now, _next_send_slot)
+        _next_send_slot = slot + 1 / REMINDER_SEND_RATE
+    if slot > now:
+        time.sleep(slot - now)
+
+
+_MSG_REMINDER_24H = (
+    "🔔 *Напоминание о записи!*\n\n"
+    "Завтра у вас прием:\n"
+    "🕐 Время: {time}\n"
+    "👨‍⚕️ Врач: {doctor_name}\n"
+    "🦷 Услуга: {service_name}\n\n"
+    "Если не можете прийти — напишите нам заранее."
+)
+
+_MSG_REMINDER_2H = (
+    "🔔 *Прием через {hours} часа!*\n\n"
+    "🕐 Время: {time}\n"
+    "👨‍⚕️ Врач: {doctor_name}\n\n"
+    "Ждём вас! Приезжайте немного раньше."
+)
+
+_MSG_REMINDER_1H = (
+    "🔔 *Прием через 1 час!*\n\n"
+    "🕐 Время: {time}\n"
+    "👨‍⚕️ Врач: {doctor_name}\n"
+    "📍 Не забудьте взять документы!\n\n"
+    "До встречи!"
+)
+
+
+def _reminder_text(appt: dict, hours: int) -> str:
+    if hours >= 24:
+        template = _MSG_REMINDER_24H
+    elif hours >= 2:
+        template = _MSG_REMINDER_2H
+    else:
+        template = _MSG_REMINDER_1H
+    return template.format(
+        time=str(appt["appointment_time"])[:5],
+        hours=hours,
+        doctor_name=appt["doctor_name"],
+        service_name=appt["service_name"],
+    )
+
+
+# Окно напоминания — ±10 минут: проверка раз в 15 минут его не пропустит
+@_quiet_when_idle("reminders", REMINDERS_INTERVAL, quiet_every=15)
+@_single_instance("reminders")
+def send_reminders() -> int:
+    """Проверить и отправить напоминания клиентам. Возвращает число найденных записей."""
+    now = datetime.now(_TZ)
     logger.info(f"Checking reminders at {now.strftime('%Y-%m-%d %H:%M:%S')} ({TIMEZONE})")
 
     wp = get_provider()
 
+    # Все окна напоминаний — одним запросом за тик (записи сразу помечены как отправленные)
+    due = db.claim_due_reminders(REMINDER_HOURS)
     for hours in REMINDER_HOURS:
-        appointments = db.get_appointments_for_reminder(hours)
-        logger.info(f"  {hours}h reminder: found {len(appointments)} appointments")
-
-        for appt in appointments:
-            if hours >= 24:
-                text = (
-                    f"🔔 *Напоминание о записи!*\n\n"
-                    f"Завтра у вас прием:\n"
-                    f"🕐 Время: {str(appt['appointment_time'])[:5]}\n"
-                    f"👨‍⚕️ Врач: {appt['doctor_name']}\n"
-                    f"🦷 Услуга: {appt['service_name']}\n\n"
-                    f"Если не можете прийти — напишите нам заранее."
-                )
-            elif hours >= 2:
-                text = (
-                    f"🔔 *Прием через {hours} часа!*\n\n"
-                    f"🕐 Время: {str(appt['appointment_time'])[:5]}\n"
-                    f"👨‍⚕️ Врач: {appt['doctor_name']}\n\n"
-                    f"Ждём вас! Приезжайте немного раньше."
-                )
-            else:
-                text = (
-                    f"🔔 *Прием через 1 час!*\n\n"
-                    f"🕐 Время: {str(appt['appointment_time'])[:5]}\n"
-                    f"👨‍⚕️ Врач: {appt['doctor_name']}\n"
-                    f"📍 Не забудьте взять документы!\n\n"
-                    f"До встречи!"
-                )
-
-            sent = wp.send_message(appt["client_phone"], text)
-            if sent:
-                db.mark_reminder_sent(appt["id"], hours)
-                logger.info(f"Reminder ({hours}h) sent to {appt['client_phone']}")
-
-
-def complete_appointments():
-    """Автоматически завершить записи, которые прошли более 1 часа назад."""
-    tz = pytz.timezone(TIMEZONE)
-    now = datetime.now(tz)
+        logger.info(f"  {hours}h reminder: found {sum(a['hours_before'] == hours for a in due)} appointments")
+    if not due:
+        return 0
+
+    def send(appt) -> bool:
+        hours = appt["hours_before"]
+        _wait_send_slot()
+        try:
+            sent = wp.send_message(appt["client_phone"], _reminder_text(appt, hours))
+        except Exception as e:
+            logger.error(f"Reminder ({hours}h) send error for {appt['client_phone']}: {e}")
+            sent = False
+        if sent:
+            logger.info(f"Reminder ({hours}h) sent to {appt['client_phone']}")
+        return sent
+
+    with ThreadPoolExecutor(max_workers=REMINDER_SEND_WORKERS, thread_name_prefix="reminder") as pool:
+        results = list(pool.map(send, due))
+
+    # Неудачные — снимаем отметку одной транзакцией, повтор на следующем тике
+    db.release_reminders([(a["id"], a["hours_before"]) for a, sent in zip(due, results) if not sent])
+    return len(due)
+
+
+@_quiet_when_idle("complete_appointments", COMPLETE_INTERVAL, quiet_every=30)
+@_single_instance("complete_appointments")
+def complete_appointments() -> int:
+    """Автоматически завершить записи, которые прошли более 1 часа назад.
+    Возвращает число завершённых записей.
+    """
+    now = datetime.now(_TZ)
     logger.info(f"Checking appointments to complete at {now.strftime('%H:%M')}")
 
-    appointments = db.get_appointments_to_complete()
+    # Статус меняется одним UPDATE; дальше только внешние системы
+    appointments = db.complete_past_appointments()
 
     if not appointments:
         logger.info("  No appointments to complete")
-        return
+        return 0
+
+    logger.info(f"  Marked {len(appointments)} appointments as completed")
 
-    logger.info(f"  Found {len(appointments)} appointments to mark as completed")
+    # Обновляем цвет в Google Calendar (серый) — batch-запросами
+    google_calendar.complete_events(appointments)
 
     for appt in appointments:
-        # Обновляем статус в БД
-        if db.mark_appointment_completed(appt["id"]):
-            # Обновляем цвет в Google Calendar (серый)
-            if appt.get("google_calendar_event_id"):
-                google_calendar.complete_event(appt["google_calendar_event_id"])
+        # Обновляем статус в Google Sheets (серый фон)
+        google_sheets.queue_status_update(appt["id"], "completed")
 
-            # Обновляем статус в Google Sheets (серый фон)
-            google_sheets.update_appointment_status(appt["id"], "completed")
+        logger.info(f"  Appointment {appt['id']} marked as completed")
 
-            logger.info(f"  Appointment {appt['id']} marked as completed")
+    return len(appointments)
 
 
 def _send_to_all_admins(msg: str):
@@ -98,6 +220,7 @@ def _send_to_all_admins(msg: str):
     send_to_all_admins(msg)
 
 
+@_single_instance("daily_report")
 def send_daily_report():
     """Отправить всем админам список записей на сегодня (каждый день в 09:00)."""
     today = date.today()
@@ -108,37 +231,47 @@ def send_daily_report():
         _send_to_all_admins(f"📅 *Записи на {today.strftime('%d.%m.%Y')}*\n\nНа сегодня записей нет.")
         return
 
-    text = f"📅 *Записи на сегодня ({today.strftime('%d.%m.%Y')}):*\n\n"
-
-    for i, appt in enumerate(appointments, 1):
-        text += (
-            f"{i}. ⏰ {str(appt['appointment_time'])[:5]}\n"
-            f"   👤 {appt.get('client_name', '—')} ({appt.get('client_phone', '')})\n"
-            f"   👨‍⚕️ {appt['doctor_name']}\n"
-            f"   🦷 {appt['service_name']}\n\n"
-        )
-
-    text += f"*Итого: {len(appointments)} записей*"
+    parts = [f"📅 *Записи на сегодня ({today.strftime('%d.%m.%Y')}):*\n\n"]
+    parts.extend(
+        f"{i}. ⏰ {str(appt['appointment_time'])[:5]}\n"
+        f"   👤 {appt.get('client_name', '—')} ({appt.get('client_phone', '')})\n"
+        f"   👨‍⚕️ {appt['doctor_name']}\n"
+        f"   🦷 {appt['service_name']}\n\n"
+        for i, appt in enumerate(appointments, 1)
+    )
+    parts.append(f"*Итого: {len(appointments)} записей*")
+    text = "".join(parts)
 
     _send_to_all_admins(text)
     logger.info(f"Daily report sent: {len(appointments)} appointments")
 
 
+@_single_instance("sync_prices")
 def sync_prices_from_sheets():
-    """Синхронизировать услуги из Google Sheets в БД."""
+    """Синхронизировать услуги и часы работы из Google Sheets в БД."""
     try:
         import google_config
         google_config.clear_cache()  # Сбросить кэш для свежих данных
         services = google_config.get_services()
         if services:
             updated = db.sync_services_from_list(services)
+            from agents.functions import invalidate_reference_caches
+            invalidate_reference_caches()
             logger.info(f"Sheets sync: {len(services)} services loaded, {updated} updated in DB")
         else:
             logger.warning("Sheets sync: Google Sheets returned empty, DB not updated")
     except Exception as e:
         logger.error(f"Sheets sync error: {e}")
 
+    # Часы работы клиники → таблица clinic_hours (fallback для get_free_slots)
+    try:
+        import google_config
+        db.sync_clinic_hours(google_config.get_clinic_hours())
+    except Exception as e:
+        logger.error(f"Clinic hours sync error: {e}")
 
+
+@_single_instance("follow_up_reminders")
 def send_follow_up_reminders():
     """Напомнить пациентам о повторных визитах (за 3 дня)."""
     try:
@@ -159,26 +292,29 @@ def send_follow_up_reminders():
         logger.error(f"Follow-up reminder error: {e}")
 
 
+@_single_instance("evening_confirmation")
 def send_evening_confirmation():
     """Вечерний отчёт админу: записи на сегодня, которые нужно подтвердить (no-show?)."""
     try:
         unconfirmed = db.get_today_unconfirmed()
         if not unconfirmed:
             return
-        wp = get_provider()
-        text = "📋 *Подтвердите посещения за сегодня:*\n\n"
-        for u in unconfirmed:
-            text += (
+        text = "".join([
+            "📋 *Подтвердите посещения за сегодня:*\n\n",
+            *(
                 f"• ID {u['id']}: {str(u['appointment_time'])[:5]} — "
                 f"{u.get('client_name', '—')} ({u['service_name']})\n"
-            )
-        text += "\nОтметьте no-show если пациент не пришёл."
+                for u in unconfirmed
+            ),
+            "\nОтметьте no-show если пациент не пришёл.",
+        ])
         _send_to_all_admins(text)
         logger.info(f"Evening confirmation sent: {len(unconfirmed)} unconfirmed")
     except Exception as e:
         logger.error(f"Evening confirmation error: {e}")
 
 
+@_single_instance("cleanup_chat_history")
 def cleanup_chat_history():
     """Удалить сообщения старше 90 дней."""
     try:
@@ -189,25 +325,38 @@ def cleanup_chat_history():
         logger.error(f"Chat history cleanup error: {e}")
 
 
+DAILY_MISFIRE_GRACE = 3600  # ежедневные задачи: опоздание до часа ещё выполняем
+
+
 def start_scheduler():
     """Запустить фоновый планировщик.
     При наличии SQLAlchemy — использует PostgreSQL jobstore (защита от дублирования при нескольких инстансах).
     """
-    tz = pytz.timezone(TIMEZONE)
 
     # Пытаемся использовать PostgreSQL jobstore для защиты от дублей
     jobstores = {}
     try:
         from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
-        db_url = f"postgresql://{DB_CONFIG['user']}:{DB_CONFIG['password']}@{DB_CONFIG['host']}:{DB_CONFIG.get('port', 5432)}/{DB_CONFIG['dbname']}"
-        jobstores["default"] = SQLAlchemyJobStore(url=db_url)
+        db_url = SCHEDULER_DB_URL or (
+            f"postgresql://{quote_plus(DB_CONFIG['user'])}:{quote_plus(DB_CONFIG['password'])}"
+            f"@{DB_CONFIG['host']}:{DB_CONFIG.get('port', 5432)}/{DB_CONFIG['dbname']}"
+        )
+        # Jobstore делает мелкие SELECT на каждом тике — двух соединений хватает
+        jobstores["default"] = SQLAlchemyJobStore(
+            url=db_url,
+            engine_options={"pool_size": 2, "max_overflow": 0, "pool_pre_ping": True},
+        )
         logger.info("Scheduler using PostgreSQL jobstore (instance-safe)")
     except ImportError:
         logger.info("SQLAlchemy not installed, using in-memory jobstore")
     except Exception as e:
         logger.warning(f"Failed to init PostgreSQL jobstore: {e}, using in-memory")
 
-    scheduler = BackgroundScheduler(timezone=tz, jobstores=jobstores)
+    # Один запуск задачи за раз; пропущенные срабатывания схлопываются в одно,
+    # а слишком поздние (интервальные — старше минуты) не запускаются вовсе —
+    # иначе медленный тик или рестарт дают повторные рассылки
+    job_defaults = {"max_instances": 1, "coalesce": True, "misfire_grace_time": 60}
+    scheduler = BackgroundScheduler(timezone=_TZ, jobstores=jobstores, job_defaults=job_defaults)
 
     # Ежедневный отчет в 09:00
     scheduler.add_job(
@@ -216,13 +365,14 @@ def start_scheduler():
         hour=9,
         minute=0,
         id="daily_report", replace_existing=True,
+        misfire_grace_time=DAILY_MISFIRE_GRACE,
     )
 
     # Проверка напоминаний каждые 5 минут
     scheduler.add_job(
         send_reminders,
         "interval",
-        minutes=5,
+        minutes=REMINDERS_INTERVAL,
         id="reminders", replace_existing=True,
     )
 
@@ -230,7 +380,7 @@ def start_scheduler():
     scheduler.add_job(
         complete_appointments,
         "interval",
-        minutes=10,
+        minutes=COMPLETE_INTERVAL,
         id="complete_appointments", replace_existing=True,
     )
 
@@ -241,6 +391,7 @@ def start_scheduler():
         hour=3,
         minute=0,
         id="cleanup_chat_history", replace_existing=True,
+        misfire_grace_time=DAILY_MISFIRE_GRACE,
     )
 
     # Синхронизация услуг из Google Sheets — раз в день в 4:00
@@ -250,10 +401,16 @@ def start_scheduler():
         hour=4,
         minute=0,
         id="sync_prices", replace_existing=True,
+        misfire_grace_time=DAILY_MISFIRE_GRACE,
     )
 
-    # Принудительная синхронизация при запуске
-    sync_prices_from_sheets()
+    # Синхронизация при запуске — в фоне через 5 секунд, старт процесса не ждёт Sheets
+    scheduler.add_job(
+        sync_prices_from_sheets,
+        "date",
+        run_date=datetime.now(_TZ) + timedelta(seconds=5),
+        id="sync_prices_initial", replace_existing=True,
+    )
 
     # Напоминания о повторных визитах — каждый день в 10:00
     scheduler.add_job(
@@ -262,6 +419,7 @@ def start_scheduler():
         hour=10,
         minute=0,
         id="follow_up_reminders", replace_existing=True,
+        misfire_grace_time=DAILY_MISFIRE_GRACE,
     )
 
     # Вечерний отчёт для подтверждения посещений — 19:00
@@ -271,6 +429,7 @@ def start_scheduler():
         hour=19,
         minute=0,
         id="evening_confirmation", replace_existing=True,
+        misfire_grace_time=DAILY_MISFIRE_GRACE,
     )
 
     scheduler.start()
@@ -67,6 +67,31 @@ DO $$ BEGIN
     IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'idx_appointments_status') THEN
         CREATE INDEX idx_appointments_status ON appointments(status);
     END IF;
+    -- Частичные индексы только по активным записям (status = 'scheduled'):
+    -- почти все горячие запросы фильтруют именно их, а такие индексы в разы меньше.
+    -- Занятость врача на дату
+    IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'idx_appointments_doctor_date') THEN
+        CREATE INDEX idx_appointments_doctor_date
+            ON appointments(doctor_id, appointment_date, appointment_time)
+            WHERE status = 'scheduled';
+    END IF;
+    -- Расписание на дату / предстоящие записи клиники
+    IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'idx_appointments_sched_date') THEN
+        CREATE INDEX idx_appointments_sched_date ON appointments(appointment_date, appointment_time)
+            WHERE status = 'scheduled';
+    END IF;
+    -- Предстоящие записи клиента: (дата, время) — уже в порядке ORDER BY
+    IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'idx_appointments_sched_client_dt') THEN
+        CREATE INDEX idx_appointments_sched_client_dt ON appointments(client_id, appointment_date, appointment_time)
+            WHERE status = 'scheduled';
+    END IF;
+    -- Заменён idx_appointments_sched_client_dt
+    DROP INDEX IF EXISTS idx_appointments_sched_client;
+    -- Окна напоминаний / автозавершения: фильтр по (appointment_date + appointment_time)
+    IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'idx_appointments_sched_dt') THEN
+        CREATE INDEX idx_appointments_sched_dt ON appointments((appointment_date + appointment_time))
+            WHERE status = 'scheduled';
+    END IF;
 END $$;
 
 -- История чата (для контекста AI)
@@ -82,6 +107,10 @@ DO $$ BEGIN
     IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'idx_chat_history_phone') THEN
         CREATE INDEX idx_chat_history_phone ON chat_history(phone, created_at DESC);
     END IF;
+    -- Окно истории в контексте клиента: keyset по id (id >= точка отсечения / последние N)
+    IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'idx_chat_history_phone_id') THEN
+        CREATE INDEX idx_chat_history_phone_id ON chat_history(phone, id);
+    END IF;
 END $$;
 
 -- Администраторы
@@ -113,6 +142,39 @@ CREATE TABLE IF NOT EXISTS doctor_absences (
     created_at  TIMESTAMP DEFAULT NOW()
 );
 
+DO $$ BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'idx_doctor_absences_doctor') THEN
+        CREATE INDEX idx_doctor_absences_doctor ON doctor_absences(doctor_id, start_date, end_date);
+    END IF;
+END $$;
+
+-- Часы работы клиники по дням недели (0=Пн, 6=Вс): fallback для врачей без doctor_schedules.
+-- Заполняется из Google Sheets при синхронизации (db.sync_clinic_hours)
+CREATE TABLE IF NOT EXISTS clinic_hours (
+    day_of_week SMALLINT PRIMARY KEY CHECK (day_of_week BETWEEN 0 AND 6),
+    start_time  TIME NOT NULL DEFAULT '09:00',
+    end_time    TIME NOT NULL DEFAULT '18:00',
+    is_open     BOOLEAN NOT NULL DEFAULT TRUE
+);
+
+INSERT INTO clinic_hours (day_of_week, start_time, end_time, is_open) VALUES
+    (0, '09:00', '18:00', TRUE),
+    (1, '09:00', '18:00', TRUE),
+    (2, '09:00', '18:00', TRUE),
+    (3, '09:00', '18:00', TRUE),
+    (4, '09:00', '18:00', TRUE),
+    (5, '10:00', '16:00', TRUE),
+    (6, '09:00', '18:00', FALSE)
+ON CONFLICT (day_of_week) DO NOTHING;
+
+-- Флаг часового напоминания (в старых базах колонки нет)
+DO $$ BEGIN
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_name = 'appointments' AND column_name = 'reminder_1h_sent') THEN
+        ALTER TABLE appointments ADD COLUMN reminder_1h_sent BOOLEAN DEFAULT FALSE;
+    END IF;
+END $$;
+
 -- Добавляем колонку причины отмены (если ещё нет)
 DO $$ BEGIN
     IF NOT EXISTS (SELECT 1 FROM information_schema.columns
@@ -157,6 +219,55 @@ DO $$ BEGIN
     END IF;
 END $$;
 
+-- Начало окна истории чата для AI (стабильный префикс для prompt cache)
+DO $$ BEGIN
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_name = 'clients' AND column_name = 'chat_window_start_id') THEN
+        ALTER TABLE clients ADD COLUMN chat_window_start_id INTEGER;
+    END IF;
+END $$;
+
+-- Интервал приёма для проверки пересечений: GiST-индекс (врач, интервал)
+-- вместо перебора всех записей врача за день с JOIN на services.
+-- duration_minutes фиксируется при записи — генерируемый столбец не может читать services.
+CREATE EXTENSION IF NOT EXISTS btree_gist;
+
+DO $$ BEGIN
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_name = 'appointments' AND column_name = 'duration_minutes') THEN
+        ALTER TABLE appointments ADD COLUMN duration_minutes INTEGER;
+        UPDATE appointments a SET duration_minutes = s.duration_minutes
+        FROM services s WHERE s.id = a.service_id;
+        ALTER TABLE appointments ALTER COLUMN duration_minutes SET DEFAULT 30;
+        ALTER TABLE appointments ALTER COLUMN duration_minutes SET NOT NULL;
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_name = 'appointments' AND column_name = 'appt_range') THEN
+        ALTER TABLE appointments ADD COLUMN appt_range tsrange GENERATED ALWAYS AS (
+            tsrange(appointment_date + appointment_time,
+                    appointment_date + appointment_time + duration_minutes * interval '1 minute')
+        ) STORED;
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'idx_appointments_conflict') THEN
+        CREATE INDEX idx_appointments_conflict ON appointments USING gist (doctor_id, appt_range)
+            WHERE status = 'scheduled';
+    END IF;
+END $$;
+
+-- Запись с клиентом, врачом и услугой — общий JOIN для выборок в db.py.
+-- Обычный VIEW: планировщик подставляет его в запрос и проталкивает фильтры в appointments.
+-- Колонки appointments идут последними: новые колонки добавляются в конец и
+-- CREATE OR REPLACE VIEW при повторном запуске проходит.
+CREATE OR REPLACE VIEW v_appointments_full AS
+SELECT c.name AS client_name, c.phone AS client_phone,
+       d.name AS doctor_name, d.specialization,
+       s.name AS service_name, s.price,
+       a.*
+FROM appointments a
+JOIN clients c ON a.client_id = c.id
+JOIN doctors d ON a.doctor_id = d.id
+JOIN services s ON a.service_id = s.id;
+
 -- =============================================
 -- Начальные данные (ON CONFLICT — не перезаписывает)
 -- =============================================
@@ -5,13 +5,47 @@
 """
 
 import logging
+import threading
+import time
+from collections import OrderedDict
 from db import get_conn
 
 logger = logging.getLogger(__name__)
 
+# Кэш phone → (chat_id | None, время загрузки). Привязки меняются редко,
+# а chat_id запрашивается на каждое уведомление; «не привязан» тоже кэшируем.
+# Размер ограничен CHAT_ID_CACHE_MAX: при переполнении вытесняются самые старые записи.
+CHAT_ID_CACHE_TTL = 300
+CHAT_ID_CACHE_MAX = 4096
+_chat_id_cache = OrderedDict()
+_phone_cache = OrderedDict()  # chat_id → (phone | None, время загрузки), тот же TTL и лимит
+_cache_lock = threading.Lock()  # кэши читаются и пишутся из пула рассылки
+
+
+def _cache_get(cache: OrderedDict, key):
+    """Значение из кэша, если оно не старше TTL; иначе None."""
+    with _cache_lock:
+        cached = cache.get(key)
+    if cached and time.monotonic() - cached[1] < CHAT_ID_CACHE_TTL:
+        return cached
+    return None
+
+
+def _cache_put(cache: OrderedDict, key, value):
+    """Записать значение в кэш и вытеснить самые старые записи сверх лимита."""
+    with _cache_lock:
+        cache[key] = (value, time.monotonic())
+        cache.move_to_end(key)
+        while len(cache) > CHAT_ID_CACHE_MAX:
+            cache.popitem(last=False)
+
 
 def get_telegram_chat_id(phone: str) -> int | None:
-    """Получить Telegram chat_id по номеру телефона."""
+    """Получить Telegram chat_id по номеру телефона (с кэшем)."""
+    cached = _cache_get(_chat_id_cache, phone)
+    if cached:
+        return cached[0]
+
     with get_conn() as conn:
         with conn.cursor() as cur:
             cur.execute(
@@ -19,11 +53,17 @@ def get_telegram_chat_id(phone: str) -> int | None:
                 (phone,)
             )
             row = cur.fetchone()
-            return row[0] if row else None
+    chat_id = row[0] if row else None
+    _cache_put(_chat_id_cache, phone, chat_id)
+    return chat_id
 
 
 def get_phone_by_telegram_chat_id(chat_id: int) -> str | None:
-    """Получить номер телефона по Telegram chat_id."""
+    """Получить номер телефона по Telegram chat_id (с кэшем)."""
+    cached = _cache_get(_phone_cache, chat_id)
+    if cached:
+        return cached[0]
+
     with get_conn() as conn:
         with conn.cursor() as cur:
             cur.execute(
@@ -31,7 +71,9 @@ def get_phone_by_telegram_chat_id(chat_id: int) -> str | None:
                 (chat_id,)
             )
             row = cur.fetchone()
-            return row[0] if row else None
+    phone = row[0] if row else None
+    _cache_put(_phone_cache, chat_id, phone)
+    return phone
 
 
 def link_telegram_user(chat_id: int, phone: str, username: str = ""):
@@ -45,4 +87,8 @@ def link_telegram_user(chat_id: int, phone: str, username: str = ""):
                    DO UPDATE SET phone = EXCLUDED.phone, username = EXCLUDED.username""",
                 (chat_id, phone, username)
             )
+    # chat_id мог переехать с другого номера — сбрасываем кэши целиком
+    with _cache_lock:
+        _chat_id_cache.clear()
+        _phone_cache.clear()
     logger.info(f"Linked Telegram chat_id={chat_id} to phone={phone}")
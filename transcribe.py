@@ -5,6 +5,7 @@ Groq предоставляет бесплатный тир с whisper-large-v3-
 
 import logging
 import requests
+from requests.adapters import HTTPAdapter
 
 from config import GROQ_API_KEY
 
@@ -12,6 +13,10 @@ logger = logging.getLogger(__name__)
 
 GROQ_WHISPER_URL = "https://api.groq.com/openai/v1/audio/transcriptions"
 
+# Общая HTTP-сессия: соединения с GREEN-API (скачивание) и Groq переиспользуются
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=0))
+
 
 def transcribe_audio(audio_url: str) -> str | None:
     """
@@ -24,11 +29,11 @@ def transcribe_audio(audio_url: str) -> str | None:
 
     try:
         # Скачиваем аудио от GREEN-API
-        audio_resp = requests.get(audio_url, timeout=30)
+        audio_resp = _SESSION.get(audio_url, timeout=30)
         audio_resp.raise_for_status()
 
         # Отправляем в Groq Whisper
-        resp = requests.post(
+        resp = _SESSION.post(
             GROQ_WHISPER_URL,
             headers={"Authorization": f"Bearer {GROQ_API_KEY}"},
             files={"file": ("audio.ogg", audio_resp.content, "audio/ogg")},
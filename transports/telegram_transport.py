@@ -36,21 +36,30 @@ class TelegramTransport(BaseTransport):
 
     def send_to_chat(self, chat_id, text: str) -> bool:
         """Отправить сообщение в Telegram чат."""
-        if not self._app:
+        future = self.submit_to_chat(chat_id, text)
+        if future is None:
             return False
         try:
-            loop = self._get_loop()
-            if not loop:
-                logger.warning("Telegram event loop not ready, cannot send message")
-                return False
-            import asyncio
-            coro = self._app.bot.send_message(chat_id=chat_id, text=text)
-            asyncio.run_coroutine_threadsafe(coro, loop).result(timeout=10)
+            future.result(timeout=10)
             return True
         except Exception as e:
             logger.error(f"Telegram send_to_chat error: {e}")
             return False
 
+    def submit_to_chat(self, chat_id, text: str):
+        """Запланировать отправку в event loop бота без ожидания.
+        Возвращает concurrent.futures.Future (или None, если бот не запущен).
+        """
+        if not self._app:
+            return None
+        loop = self._get_loop()
+        if not loop:
+            logger.warning("Telegram event loop not ready, cannot send message")
+            return None
+        import asyncio
+        coro = self._app.bot.send_message(chat_id=chat_id, text=text)
+        return asyncio.run_coroutine_threadsafe(coro, loop)
+
     def _get_loop(self):
         """Получить event loop бота."""
         if hasattr(self, '_loop') and self._loop:
@@ -76,6 +85,7 @@ class TelegramTransport(BaseTransport):
         import asyncio
         import db
         import telegram_db
+        from whatsapp import PHONE_TRANS
 
         WAITING_PHONE = 1
 
@@ -102,7 +112,7 @@ class TelegramTransport(BaseTransport):
             """Получить и привязать телефон."""
             raw = update.message.text.strip()
             # Нормализация: убираем пробелы, скобки, дефисы
-            phone = raw.replace(" ", "").replace("-", "").replace("(", "").replace(")", "")
+            phone = raw.translate(PHONE_TRANS)
 
             # Если начинается с 8 — заменяем на +7
             if phone.startswith("8") and len(phone) == 11:
@@ -12,11 +12,18 @@ logger = logging.getLogger(__name__)
 
 class WhatsAppTransport(BaseTransport):
     def __init__(self):
-        self._provider = get_provider()
+        self._provider = None
+
+    @property
+    def provider(self):
+        """GREEN-API провайдер — создаётся при первой отправке, а не при создании транспорта."""
+        if self._provider is None:
+            self._provider = get_provider()
+        return self._provider
 
     def send_message(self, phone: str, text: str) -> bool:
         """Отправить сообщение через GREEN-API."""
-        return self._provider.send_message(phone, text)
+        return self.provider.send_message(phone, text)
 
     def send_to_chat(self, chat_id, text: str) -> bool:
         """WhatsApp не использует chat_id — перенаправляем на send_message."""
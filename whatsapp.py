@@ -2,8 +2,11 @@
 WhatsApp интеграция через GREEN-API (green-api.com).
 """
 
-import requests
+import atexit
 import logging
+import threading
+
+import httpx
 
 from config import GREEN_API_INSTANCE_ID, GREEN_API_TOKEN
 
@@ -17,9 +20,13 @@ GREEN_API_URL = os.getenv(
 )
 
 
+# Пробелы, дефисы и скобки из номера — один проход str.translate
+PHONE_TRANS = str.maketrans("", "", " -()")
+
+
 def normalize_phone(phone: str) -> str:
     """Приводит номер к формату +7XXXXXXXXXX."""
-    phone = phone.replace(" ", "").replace("-", "").replace("(", "").replace(")", "")
+    phone = phone.translate(PHONE_TRANS)
     if phone.endswith("@c.us"):
         phone = "+" + phone.replace("@c.us", "")
     if not phone.startswith("+"):
@@ -34,6 +41,18 @@ class GreenAPIProvider:
         self.instance_id = GREEN_API_INSTANCE_ID
         self.token = GREEN_API_TOKEN
         self.base_url = GREEN_API_URL
+        # Один HTTP/2-клиент на провайдера: параллельные отправки мультиплексируются
+        # в одном TCP+TLS соединении с GREEN-API. retries — только сбои соединения.
+        self.session = httpx.Client(
+            timeout=10.0,
+            transport=httpx.HTTPTransport(
+                http2=True,
+                retries=2,
+                limits=httpx.Limits(max_connections=8, max_keepalive_connections=4),
+            ),
+        )
+        atexit.register(self.session.close)
+        self._send_url = self._url("sendMessage")  # URL не меняется — собираем один раз
         logger.info(f"[GREEN-API] URL: {self.base_url}, instance: {self.instance_id}")
 
     def _url(self, method: str) -> str:
@@ -43,10 +62,9 @@ class GreenAPIProvider:
         """Отправить текстовое сообщение."""
         try:
             chat_id = phone.lstrip("+") + "@c.us"
-            resp = requests.post(
-                self._url("sendMessage"),
+            resp = self.session.post(
+                self._send_url,
                 json={"chatId": chat_id, "message": text},
-                timeout=10,
             )
             resp.raise_for_status()
             logger.info(f"[GREEN-API] Sent to {phone}")
@@ -104,6 +122,15 @@ class GreenAPIProvider:
             return None
 
 
+_provider = None
+_provider_lock = threading.Lock()
+
+
 def get_provider():
-    """Получить WhatsApp провайдера."""
-    return GreenAPIProvider()
+    """Получить WhatsApp провайдера (singleton — общая HTTP-сессия)."""
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                _provider = GreenAPIProvider()
+    return _provider